@@ -1,3 +1,5 @@
+import signal
+
 import rock as rk
 
 
@@ -13,16 +15,114 @@ def main():
         '-a', '--addr', dest='addr',
         help='broker port', default='tcp://*:5555'
     )
+    parser.add_argument(
+        '-b', '--budget', dest='budget', type=int,
+        help='max messages handled per wakeup', default=1
+    )
+    parser.add_argument(
+        '-z', '--zerocopy', dest='zerocopy',
+        help='forward message bodies without copying', action='store_true'
+    )
+    parser.add_argument(
+        '-s', '--shards', dest='shards', type=int,
+        help='number of broker shard processes', default=0
+    )
+    parser.add_argument(
+        '-f', '--federate', dest='federate',
+        help='endpoint to advertise capacity to peers on'
+    )
+    parser.add_argument(
+        '-p', '--peer', dest='peers', action='append', nargs=2,
+        metavar=('ADDR', 'STATE'), default=[],
+        help='peer broker endpoint and its capacity endpoint'
+    )
+    parser.add_argument(
+        '-q', '--queue-limit', dest='queue_limit', type=int,
+        help='max queued requests per service, 0 for no limit', default=0
+    )
+    parser.add_argument(
+        '-l', '--limit', dest='limits', action='append', nargs=2,
+        metavar=('SERVICE', 'LIMIT'), default=[],
+        help='max queued requests for one service'
+    )
+    parser.add_argument(
+        '-d', '--drop-oldest', dest='drop_oldest',
+        help='when a queue is full shed the oldest request',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-w', '--weights', dest='weights', type=int, nargs='+',
+        help='dispatch weights of the high, normal and low priorities'
+    )
+    parser.add_argument(
+        '-r', '--routing', dest='routing', default='lru',
+        choices=sorted(rk.mdp.routing.STRATEGIES),
+        help='how requests are routed to workers'
+    )
+    parser.add_argument(
+        '-R', '--route', dest='routes', action='append', nargs=2,
+        metavar=('SERVICE', 'ROUTING'), default=[],
+        help='how requests are routed to workers of one service'
+    )
+    parser.add_argument(
+        '-j', '--journal', dest='journal',
+        help='directory to log queued requests to, replayed on restart'
+    )
+    parser.add_argument(
+        '-F', '--fsync', dest='fsync', default='batch',
+        choices=rk.mdp.journal.FSYNC,
+        help='when the journal is synced to disk'
+    )
+    parser.add_argument(
+        '-S', '--snapshot', dest='snapshot',
+        help='file to save workers to, restored on restart'
+    )
     parser.add_argument(
         '-v', '--verbose', dest='verbose',
         help='verbose logging', action='store_true'
     )
     options = parser.parse_args()
-    broker = rk.mdp.broker.MajorDomoBroker(
-        options.name, options.verbose
+    if options.shards > 0 and (options.federate or options.peers):
+        parser.error('federation is not supported with sharding')
+    kwargs = dict(
+        budget=options.budget,
+        zerocopy=options.zerocopy,
+        queue_limit=options.queue_limit,
+        limits=dict(
+            (service.encode('utf-8'), int(limit))
+            for service, limit in options.limits
+        ),
+        drop_oldest=options.drop_oldest,
+        weights=options.weights,
+        routing=options.routing,
+        routes=dict(
+            (service.encode('utf-8'), routing)
+            for service, routing in options.routes
+        ),
+        journal=options.journal,
+        fsync=options.fsync,
+        snapshot=options.snapshot
     )
+    if options.shards > 0:
+        broker = rk.mdp.shard.ShardRouter(
+            options.name, options.shards, options.verbose, **kwargs
+        )
+    else:
+        broker = rk.mdp.broker.MajorDomoBroker(
+            options.name, options.verbose, **kwargs
+        )
     broker.bind(options.addr)
-    broker.mediate()
+    if options.federate:
+        broker.federate(options.federate)
+    for addr, state in options.peers:
+        broker.peer(addr, state)
+    signal.signal(signal.SIGTERM, rk.mdp.broker.terminate)
+    try:
+        broker.mediate()
+    except KeyboardInterrupt:
+        pass  # Stopped outside of a poll
+    finally:
+        broker.destroy()
 
 
 if __name__ == "__main__":
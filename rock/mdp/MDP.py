@@ -2,6 +2,14 @@
 #  This is the version of MDP/Client we implement
 C_CLIENT = b"MDPC01"
 
+#  Extended MDP/Client, a properties frame (msgpack map) follows the
+#  service name and is handed back with the reply
+C_CLIENT_X = b"MDPCX1"
+
+#  First frame of a batch of rpc calls, a frame per call follows, and
+#  of its reply, with a frame per result
+B_BATCH = b"MDPB01"
+
 #  This is the version of MDP/Worker we implement
 W_WORKER = b"MDPW01"
 
@@ -12,4 +20,16 @@ W_REPLY = b"\003"
 W_HEARTBEAT = b"\004"
 W_DISCONNECT = b"\005"
 
+#  Replies the broker sends itself, return codes as in 8/MMI
+R_OK = b"200"
+R_NOT_FOUND = b"404"
+R_NOT_IMPLEMENTED = b"501"
+R_BUSY = b"503"
+R_TIMEOUT = b"504"
+
+#  Request priority classes, sent as the `priority` property
+P_HIGH = 0
+P_NORMAL = 1
+P_LOW = 2
+
 commands = [None, b"READY", b"REQUEST", b"REPLY", b"HEARTBEAT", b"DISCONNECT"]
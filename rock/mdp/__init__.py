@@ -2,5 +2,15 @@ from . import MDP
 from . import zhelpers
 from . import client
 from . import aclient
+from . import aioclient
 from . import worker
+from . import aioworker
 from . import broker
+from . import ring
+from . import routing
+from . import shard
+from . import stats
+from . import journal
+from . import wheel
+from . import pool
+from . import circuit
@@ -4,28 +4,73 @@ Author: Min RK <benjaminrk@gmail.com>
 Based on Java example by Arkadiusz Orzechowski
 """
 
+import time
+import uuid
+import heapq
+import concurrent.futures
 import zmq
 
 from . import MDP
-from .zhelpers import dump
-from .. import utils
+from .zhelpers import dump, context
+from .. import utils, msg as codec
+
+
+class Reply(concurrent.futures.Future):
+    """Future reply to a call, the reply frames or None if none came.
+    Waiting on it reads replies off the client's socket, so a single
+    thread can wait on many calls in any order.
+    """
+
+    def __init__(self, client, deadline, convert=None):
+        super(Reply, self).__init__()
+        self.client = client
+        self.deadline = deadline  # When we stop waiting for the reply
+        self.convert = convert  # Applied to the reply before it is set
+
+    def resolve(self, msg):
+        try:
+            self.set_result(msg if self.convert is None else self.convert(msg))
+        except Exception as e:
+            self.set_exception(e)
+
+    def result(self, timeout=None):
+        end = None if timeout is None else time.time() + timeout
+        while not self.done():
+            wait = self.deadline - time.time()
+            if end is not None:
+                if end <= time.time():
+                    raise concurrent.futures.TimeoutError()
+                wait = min(wait, end - time.time())
+            self.client.poll(1e3*max(0, wait))
+        return super(Reply, self).result(0)
 
 
 class MajorDomoClient(object):
     """Majordomo Protocol Client API, Python version.
       Implements the MDP/Worker spec at http:#rfc.zeromq.org/spec:7.
+    Every request carries a correlation id, so many calls can be in
+    flight at once and replies are matched to them in any order.
     """
     broker = None
     ctx = None
     client = None
+    identity = None  # Routing id, kept across reconnects and broker restarts
     poller = None
     timeout = 2500
     verbose = False
+    pipelined = True  # Many calls share the socket
+
+    sequence = 0  # last correlation id
+    pending = None  # Replies to calls in flight by id
+    deadlines = None  # Heap of (deadline, id) of those calls
 
     def __init__(self, broker, name, verbose=False):
         self.broker = broker
         self.verbose = verbose
-        self.ctx = zmq.Context()
+        self.pending = {}
+        self.deadlines = []
+        self.identity = uuid.uuid4().hex.encode('utf-8')
+        self.ctx = context()
         self.poller = zmq.Poller()
         self.log = utils.logger(f"{name}.client")
         self.reconnect_to_broker()
@@ -37,13 +82,16 @@ class MajorDomoClient(object):
             self.client.close()
         self.client = self.ctx.socket(zmq.DEALER)
         self.client.linger = 0
+        self.client.identity = self.identity
         self.client.connect(self.broker)
         self.poller.register(self.client, zmq.POLLIN)
         if self.verbose:
             self.log.info("I: connecting to broker at %s...", self.broker)
 
-    def send(self, service, request):
-        """Send request to broker
+    def send(self, service, request, priority=None, key=None, timeout=None):
+        """Send request to broker, optionally with a priority class and
+        a routing key. Returns the request's correlation id.
+        timeout, in msecs, defaults to the client's.
         """
         if not isinstance(request, list):
             request = [request]
@@ -52,13 +100,78 @@ class MajorDomoClient(object):
         # Frame 0: empty (REQ emulation)
         # Frame 1: "MDPCxy" (six bytes, MDP/Client x.y)
         # Frame 2: Service name (printable string)
+        # Frame 3: Properties, the correlation id, the time we give up
+        #          waiting at, priority and routing key
 
-        request = [b'', MDP.C_CLIENT, service] + request
+        if timeout is None:
+            timeout = self.timeout
+        self.sequence += 1
+        props = dict(cid=self.sequence, deadline=time.time() + 1e-3*timeout)
+        if priority is not None:
+            props['priority'] = priority
+        if key is not None:
+            props['key'] = key
+        props = codec.pack(props)
+        request = [b'', MDP.C_CLIENT_X, service, props] + request
         if self.verbose:
             self.log.warn("I: send request to '%s' service: ",
                           service.decode('utf-8'))
             dump(request)
         self.client.send_multipart(request)
+        return self.sequence
+
+    def call(self, service, request, priority=None, key=None,
+             callback=None, convert=None, timeout=None):
+        """Send request to broker, returns a Reply future.
+        callback(reply) is called with the Reply once it is done, and
+        convert, if any, is applied to the reply frames first.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        cid = self.send(service, request, priority, key, timeout)
+        reply = Reply(self, time.time() + 1e-3*timeout, convert)
+        if callback is not None:
+            reply.add_done_callback(callback)
+        self.pending[cid] = reply
+        heapq.heappush(self.deadlines, (reply.deadline, cid))
+        return reply
+
+    def poll(self, timeout=0):
+        """Wait up to timeout msecs for replies to calls in flight and
+        settle them, along with calls past their deadline.
+        Returns how many calls were settled.
+        """
+        settled = 0
+        try:
+            items = self.poller.poll(timeout)
+        except KeyboardInterrupt:
+            items = None  # interrupted
+        while items:
+            try:
+                msg = self.client.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if self.verbose:
+                self.log.info("I: received reply:")
+                dump(msg)
+            assert len(msg) >= 5 and MDP.C_CLIENT_X == msg[1]
+            cid = codec.unpack(msg[3]).get('cid')
+            reply = self.pending.pop(cid, None)
+            if reply is not None:
+                reply.resolve(msg[4:])
+                settled += 1
+            elif self.verbose:
+                self.log.warn("W: dropping late reply %s", cid)
+
+        # Settle calls past their deadline, answered ones are skipped
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, cid = heapq.heappop(self.deadlines)
+            reply = self.pending.pop(cid, None)
+            if reply is not None:
+                reply.resolve(None)
+                settled += 1
+        return settled
 
     def recv(self):
         """Returns the reply message or None if there was no reply."""
@@ -75,13 +188,14 @@ class MajorDomoClient(object):
                 dump(msg)
 
             # Don't try to handle errors, just assert noisily
-            assert len(msg) >= 4
+            assert len(msg) >= 5
 
             empty = msg.pop(0)
             header = msg.pop(0)
-            assert MDP.C_CLIENT == header
+            assert MDP.C_CLIENT_X == header
 
             service = msg.pop(0)
+            props = msg.pop(0)
             return msg
         else:
             self.log.warn("W: permanent error, abandoning request")
@@ -0,0 +1,104 @@
+"""Majordomo Protocol Client API for asyncio, Python version.
+Implements the MDP/Client spec at http:#rfc.zeromq.org/spec:7, with
+zmq.asyncio, so calls are awaited on the event loop. Requests carry a
+correlation id and any number of calls can be in flight at once.
+"""
+
+import time
+import uuid
+import asyncio
+import zmq
+import zmq.asyncio
+
+from . import MDP
+from .zhelpers import dump, async_context
+from .. import utils, msg as codec
+
+
+class MajorDomoClient(object):
+    """Majordomo Protocol Client API for asyncio."""
+    broker = None
+    ctx = None
+    client = None
+    identity = None  # Routing id, kept across reconnects and broker restarts
+    timeout = 2500
+    verbose = False
+    pipelined = True  # Many calls share the socket
+
+    sequence = 0  # last correlation id
+    pending = None  # Futures of calls in flight by correlation id
+    reader = None  # Task matching replies to calls
+
+    def __init__(self, broker, name, verbose=False):
+        self.broker = broker
+        self.verbose = verbose
+        self.pending = {}
+        self.identity = uuid.uuid4().hex.encode('utf-8')
+        self.ctx = async_context()
+        self.log = utils.logger(f"{name}.client")
+        self.reconnect_to_broker()
+
+    def reconnect_to_broker(self):
+        """Connect or reconnect to broker"""
+        if self.reader:
+            self.reader.cancel()
+            self.reader = None
+        if self.client:
+            self.client.close()
+        self.client = self.ctx.socket(zmq.DEALER)
+        self.client.linger = 0
+        self.client.identity = self.identity
+        self.client.connect(self.broker)
+        if self.verbose:
+            self.log.info("I: connecting to broker at %s...", self.broker)
+
+    async def send(self, service, request, priority=None, key=None):
+        """Send request to broker and wait for its reply.
+        Returns the reply message or None if there was no reply.
+        """
+        if not isinstance(request, list):
+            request = [request]
+
+        self.sequence += 1
+        cid = self.sequence
+        props = dict(cid=cid, deadline=time.time() + 1e-3*self.timeout)
+        if priority is not None:
+            props['priority'] = priority
+        if key is not None:
+            props['key'] = key
+        request = [b'', MDP.C_CLIENT_X, service, codec.pack(props)] + request
+        if self.verbose:
+            self.log.info("I: send request to '%s' service: ",
+                          service.decode('utf-8'))
+            dump(request)
+
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.ensure_future(self.read())
+        reply = self.pending[cid] = asyncio.get_event_loop().create_future()
+        try:
+            await self.client.send_multipart(request)
+            return await asyncio.wait_for(reply, 1e-3*self.timeout)
+        except asyncio.TimeoutError:
+            self.log.warn("W: permanent error, abandoning request")
+            return None
+        finally:
+            self.pending.pop(cid, None)
+
+    async def read(self):
+        """Hand replies to the calls waiting for them."""
+        while True:
+            msg = await self.client.recv_multipart()
+            if self.verbose:
+                self.log.info("I: received reply:")
+                dump(msg)
+
+            # Don't try to handle errors, just assert noisily
+            assert len(msg) >= 5 and MDP.C_CLIENT_X == msg[1]
+            reply = self.pending.get(codec.unpack(msg[3]).get('cid'))
+            if reply is not None and not reply.done():
+                reply.set_result(msg[4:])
+
+    def destroy(self):
+        if self.reader:
+            self.reader.cancel()
+        self.client.close()
@@ -0,0 +1,169 @@
+"""Majordomo Protocol Worker API for asyncio, Python version.
+Implements the MDP/Worker spec at http:#rfc.zeromq.org/spec:7, with
+zmq.asyncio. Each request runs as its own task, so with credit for
+several requests an async handler serves them concurrently.
+"""
+
+import time
+import uuid
+import asyncio
+import zmq
+import zmq.asyncio
+
+from .zhelpers import dump, async_context
+from . import MDP
+from .worker import unwrap
+from .. import utils
+
+
+class MajorDomoWorker(object):
+    """Majordomo Protocol Worker API for asyncio."""
+
+    HEARTBEAT_LIVENESS = 3  # 3-5 is reasonable
+    broker = None
+    ctx = None
+    service = None
+
+    worker = None  # Socket to broker
+    identity = None  # Routing id, kept across reconnects and broker restarts
+    generation = 0  # Bumped on reconnect, replies to older requests are dropped
+    liveness = 0  # How many attempts left
+    heartbeat = 2500  # Heartbeat delay, msecs
+    reconnect = 2500  # Reconnect delay, msecs
+
+    verbose = False  # Print activity to stdout
+    expired = 0  # Requests skipped because their deadline passed
+
+    prefetch = 1  # Credit, how many requests the broker may send at once
+    tasks = None  # Requests being handled
+
+    def __init__(self, broker, service, verbose=False, prefetch=1):
+        self.broker = broker
+        if type(service) == str:
+            service = bytes(service, 'utf-8')
+        self.service = service
+        self.verbose = verbose
+        self.prefetch = max(1, prefetch)
+        self.identity = uuid.uuid4().hex.encode('utf-8')
+        self.tasks = set()
+        self.ctx = async_context()
+        self.log = utils.logger(
+            f"{service.decode('utf-8')}.service"
+        )
+
+    async def reconnect_to_broker(self):
+        """Connect or reconnect to broker"""
+        if self.worker:
+            self.worker.close()
+        self.worker = self.ctx.socket(zmq.DEALER)
+        self.worker.linger = 0
+        self.worker.identity = self.identity
+        self.worker.connect(self.broker)
+        self.generation += 1
+        if self.verbose:
+            self.log.info("I: connecting to broker at %s...", self.broker)
+
+        # Register service with broker
+        credit = [b'%d' % self.prefetch] if self.prefetch > 1 else []
+        await self.send_to_broker(MDP.W_READY, self.service, credit)
+
+        # If liveness hits zero, queue is considered disconnected
+        self.liveness = self.HEARTBEAT_LIVENESS
+
+    async def send_to_broker(self, command, option=None, msg=None):
+        """Send message to broker.
+        If no msg is provided, creates one internally
+        """
+        if msg is None:
+            msg = []
+        elif not isinstance(msg, list):
+            msg = [msg]
+
+        if option:
+            msg = [option] + msg
+
+        msg = [b'', MDP.W_WORKER, command] + msg
+        if self.verbose:
+            self.log.info("I: sending %s to broker", command)
+            dump(msg)
+        await self.worker.send_multipart(msg)
+
+    async def run(self, handler):
+        """Serve requests until cancelled.
+        `await handler(msg, properties)` returns the reply to a request,
+        properties are those of an extended client, or empty.
+        """
+        await self.reconnect_to_broker()
+        while True:
+            try:
+                msg = await asyncio.wait_for(
+                    self.worker.recv_multipart(), 1e-3*self.heartbeat
+                )
+            except asyncio.TimeoutError:
+                self.liveness -= 1
+                if self.liveness == 0:
+                    if self.verbose:
+                        self.log.warn(
+                            "W: disconnected from broker - retrying...")
+                    await asyncio.sleep(1e-3*self.reconnect)
+                    await self.reconnect_to_broker()
+                else:
+                    # A quiet heartbeat interval, so it's time to send one
+                    await self.send_to_broker(MDP.W_HEARTBEAT)
+                continue
+
+            if self.verbose:
+                self.log.info("I: received message from broker: ")
+                dump(msg)
+
+            self.liveness = self.HEARTBEAT_LIVENESS
+            # Don't try to handle errors, just assert noisily
+            assert len(msg) >= 3
+
+            empty = msg.pop(0)
+            assert empty == b''
+
+            header = msg.pop(0)
+            assert header == MDP.W_WORKER
+
+            command = msg.pop(0)
+            if command == MDP.W_REQUEST:
+                empty = msg.index(b'')
+                task = asyncio.ensure_future(
+                    self.handle(handler, msg[:empty], msg[empty + 1:])
+                )
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            elif command == MDP.W_HEARTBEAT:
+                await self.send_to_broker(MDP.W_HEARTBEAT)
+            elif command == MDP.W_DISCONNECT:
+                await self.reconnect_to_broker()
+            else:
+                self.log.error("E: invalid input message: ")
+                dump(msg)
+
+    async def handle(self, handler, reply_to, msg):
+        """Run handler on one request and send back its reply."""
+        generation = self.generation
+        properties = unwrap(reply_to, self.prefetch)
+        deadline = properties.get('deadline')
+        if deadline is not None and deadline < time.time():
+            self.expired += 1
+            reply = [MDP.R_TIMEOUT]
+        else:
+            try:
+                reply = await handler(msg, properties)
+            except Exception as err:
+                self.log.exception(err)
+                reply = []
+        # Requests sent to an older socket can no longer be answered
+        if generation == self.generation:
+            await self.send_to_broker(
+                MDP.W_REPLY, msg=reply_to + [b''] + reply
+            )
+
+    def destroy(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.worker:
+            self.worker.close()
@@ -6,28 +6,220 @@ Based on Java example by Arkadiusz Orzechowski
 """
 
 
+import os
 import sys
 import time
+import collections
 from binascii import hexlify
 
 import zmq
 
 # local
 from . import MDP
-from .zhelpers import dump
-from .. import utils
+from .journal import Journal
+from .routing import STRATEGIES
+from .stats import Histogram
+from .wheel import TimerWheel
+from .zhelpers import dump, frame_bytes
+from .. import utils, msg as codec
+
+
+def unwrap(msg):
+    """Split [client, (properties), '', body...] into envelope and body.
+    Only extended clients have a properties frame, and it is never empty.
+    """
+    k = 2 if len(msg[1]) else 1
+    return msg[:k], msg[k + 1:]
+
+
+def properties(frame):
+    """Client properties in frame, None unless it holds a msgpack map.
+    Clients can send anything, so a bad frame is served as a plain
+    request rather than raise.
+    """
+    try:
+        props = codec.unpack(frame_bytes(frame))
+    except Exception:
+        return None
+    return props if isinstance(props, dict) else None
+
+
+def terminate(signum, frame):
+    """SIGTERM handler, stops mediate the way Ctrl-C does."""
+    raise KeyboardInterrupt
+
+
+def schedule(weights):
+    """Smooth weighted round robin order of priority classes.
+    Each class k shows up weights[k] times, spread out evenly.
+    """
+    total = sum(weights)
+    current = [0] * len(weights)
+    order = []
+    for _ in range(total):
+        for k, weight in enumerate(weights):
+            current[k] += weight
+        k = current.index(max(current))
+        current[k] -= total
+        order.append(k)
+    return order
+
+
+class Request(object):
+    """a client request, queued or in flight"""
+    __slots__ = (
+        'msg', 'properties', 'deadline', 'priority', 'key', 'queued', 'sent',
+        'id'
+    )
+
+    def __init__(self, msg, properties=None):
+        self.msg = msg  # [client, (properties), '', body...]
+        self.properties = properties  # Extended clients only
+        self.deadline = None  # Client gives up at this point
+        self.priority = MDP.P_NORMAL  # Priority class
+        self.key = None  # Routing key, for worker affinity
+        self.queued = None  # When it joined the service queue
+        self.sent = None  # When it went to a worker
+        self.id = None  # Journal id, while it is logged as queued
+        if properties:
+            # Sent by clients, so ill-typed ones are ignored
+            deadline = properties.get('deadline')
+            if isinstance(deadline, (int, float)):
+                self.deadline = deadline
+            priority = properties.get('priority')
+            if isinstance(priority, int):
+                self.priority = priority
+            self.key = properties.get('key')
+
+    def expired(self, now):
+        return self.deadline is not None and self.deadline < now
+
+
+class RequestQueue(object):
+    """Queued requests of a service, a FIFO per priority class.
+    Classes take turns by weight, so low priority requests still get their
+    share, and picking the next request is constant time.
+    """
+
+    def __init__(self, weights):
+        self.queues = [collections.deque() for w in weights]
+        self.order = schedule([max(1, w) for w in weights])
+        self.turn = 0  # position in order
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for queue in self.queues:
+            yield from queue
+
+    def index(self, request):
+        """Priority class of request, out of range ones are clamped."""
+        return min(max(request.priority, 0), len(self.queues) - 1)
+
+    def append(self, request):
+        self.queues[self.index(request)].append(request)
+        self.length += 1
+
+    def appendleft(self, request):
+        self.queues[self.index(request)].appendleft(request)
+        self.length += 1
+
+    def next(self):
+        """Finds the turn whose class has requests, from the current."""
+        for k in range(len(self.order)):
+            turn = (self.turn + k) % len(self.order)
+            if self.queues[self.order[turn]]:
+                return turn
+        raise IndexError('pop from an empty queue')
+
+    def peek(self):
+        return self.queues[self.order[self.next()]][0]
+
+    def popleft(self):
+        turn = self.next()
+        self.turn = (turn + 1) % len(self.order)
+        self.length -= 1
+        return self.queues[self.order[turn]].popleft()
+
+    def shed(self, request):
+        """Make room for request by dropping the oldest request of the
+        lowest priority class, unless request itself is lower still.
+        Returns the request that has to go.
+        """
+        lowest = max(k for k, queue in enumerate(self.queues) if queue)
+        if lowest < self.index(request):
+            return request
+        self.queues[self.index(request)].append(request)
+        return self.queues[lowest].popleft()
+
+    def trim(self, now):
+        """Drops expired requests from the head of each class, returns
+        them. Deadlines mostly grow along a queue, so this finds most
+        of them, at the cost of the requests dropped.
+        """
+        dropped = []
+        for queue in self.queues:
+            while queue and queue[0].expired(now):
+                dropped.append(queue.popleft())
+        self.length -= len(dropped)
+        return dropped
+
+    def expire(self, now):
+        """Drops all expired requests, returns them."""
+        dropped = []
+        for k, queue in enumerate(self.queues):
+            requests = []
+            for r in queue:
+                (dropped if r.expired(now) else requests).append(r)
+            self.queues[k] = collections.deque(requests)
+        self.length -= len(dropped)
+        return dropped
 
 
 class Service(object):
     """a single Service"""
     name = None  # Service name
-    requests = None  # List of client requests
-    waiting = None  # List of waiting workers
+    requests = None  # Queue of client requests, by priority
+    waiting = None  # Idle workers by identity, longest idle first
+    limit = 0  # Max queued requests, 0 for no limit
+    strategy = None  # Picks the waiting worker a request goes to
+    workers = 0  # Workers attached to the service
+    dispatched = 0  # Requests sent to workers
+    replied = 0  # Replies from workers
+    forwarded = 0  # Requests handed to peer brokers
+    rejected = 0  # Requests shed because the queue was full
+    expired = 0  # Requests dropped because their deadline passed
+    waits = None  # Time requests spent queued
+    times = None  # Time workers took to reply
 
-    def __init__(self, name):
+    def __init__(self, name, limit=0, weights=(1,), strategy=None):
         self.name = name
-        self.requests = []
-        self.waiting = []
+        self.limit = limit
+        self.strategy = strategy or STRATEGIES['lru']()
+        self.requests = RequestQueue(weights)
+        self.waiting = collections.OrderedDict()
+        self.waits = Histogram()
+        self.times = Histogram()
+
+    def stats(self):
+        """Counters and histograms, as plain data."""
+        idle = sum(1 for w in self.waiting.values() if not w.outstanding)
+        return dict(
+            queued=len(self.requests),
+            queues=[len(queue) for queue in self.requests.queues],
+            workers=self.workers,
+            idle=idle,
+            busy=self.workers - idle,
+            dispatched=self.dispatched,
+            replied=self.replied,
+            forwarded=self.forwarded,
+            rejected=self.rejected,
+            expired=self.expired,
+            wait=self.waits.dump(),
+            service=self.times.dump()
+        )
 
 
 class Worker(object):
@@ -36,11 +228,34 @@ class Worker(object):
     address = None  # Address to route to
     service = None  # Owning service, if known
     expiry = None  # expires at this point, unless heartbeat
+    heartbeat_at = None  # When its heartbeat timer next fires
+    sent_at = None  # When its last request went out, with credit 1
+    probing = False  # Restored from a snapshot, not heard from yet
+    credit = 1  # Requests the worker takes at once
+    outstanding = None  # Requests in flight by tag, if credit > 1
+    sequence = 0  # last request tag
 
     def __init__(self, identity, address, lifetime):
         self.identity = identity
         self.address = address
         self.expiry = time.time() + 1e-3*lifetime
+        self.outstanding = collections.OrderedDict()
+
+
+class Peer(object):
+    """a peer Broker we can forward requests to"""
+    endpoint = None  # Peer broker endpoint
+    socket = None  # DEALER to the peer, we are a client to it
+    state = None  # SUB to the peer's capacity adverts
+    capacity = None  # idle workers per service, as last advertised
+    expiry = None  # capacity is stale at this point
+
+    def __init__(self, endpoint, socket, state):
+        self.endpoint = endpoint
+        self.socket = socket
+        self.state = state
+        self.capacity = {}
+        self.expiry = 0
 
 
 class MajorDomoBroker(object):
@@ -54,83 +269,275 @@ class MajorDomoBroker(object):
     HEARTBEAT_LIVENESS = 3  # 3-5 is reasonable
     HEARTBEAT_INTERVAL = 2500  # msecs
     HEARTBEAT_EXPIRY = HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+    TIMER_RESOLUTION = 50  # msecs per timer wheel tick
+    PHASE_STEP = 0.6180339887  # golden ratio, spreads heartbeat phases
+    PROBE_INTERVAL = 250  # msecs between probes of restored workers
+    PRIORITY_WEIGHTS = (16, 4, 1)  # share of dispatches per priority class
+    ADVERTISE_INTERVAL = 250  # msecs between capacity adverts to peers
 
     # ---------------------------------------------------------------------
 
     ctx = None  # Our context
     socket = None  # Socket for clients & workers
+    socket_type = zmq.ROUTER  # DEALER when running behind a router
     poller = None  # our Poller
+    budget = 1  # Max messages handled per poll wakeup
+    outbox = None  # Messages queued for sending while draining
+    zerocopy = False  # Forward body frames as zmq.Frame, uncopied
 
-    heartbeat_at = None  # When to send HEARTBEAT
+    name = None  # Broker name, also used to tag forwarded requests
+    purge_at = None  # When to purge requests forwarded to peers
+    timers = None  # Worker heartbeat timers, by identity
+    phase = 0.0  # Heartbeat phase of the last worker, within interval
     services = None  # known services
     workers = None  # known workers
-    waiting = None  # idle workers
+    waiting = None  # idle workers by identity
+
+    state = None  # PUB for our capacity adverts, if federated
+    advertise_at = None  # When to advertise capacity
+    peers = None  # peer brokers
+    forwarded = None  # requests sent to peers by id, oldest first
+    sequence = 0  # last forwarded request id
+
+    queue_limit = 0  # Default max queued requests per service
+    limits = None  # Max queued requests by service name
+    drop_oldest = False  # When full, shed the oldest request, not the new
+    weights = PRIORITY_WEIGHTS  # Dispatch weight per priority class
+    routing = 'lru'  # Default routing strategy
+    routes = None  # Routing strategy by service name
+    journal = None  # Durable log of queued requests, if any
+    snapshot = None  # File the worker registry is saved to, if any
+    changed = False  # Registry changed since the last snapshot
 
     verbose = False  # Print activity to stdout
 
     # ---------------------------------------------------------------------
 
-    def __init__(self, name, verbose=False):
-        """Initialize broker state."""
+    def __init__(self, name, verbose=False, budget=1, zerocopy=False,
+                 queue_limit=0, drop_oldest=False, limits=None,
+                 weights=None, routing='lru', routes=None, journal=None,
+                 fsync='batch', snapshot=None):
+        """Initialize broker state.
+        With a journal directory, queued requests are logged there and
+        replayed when the broker starts. With a snapshot file, workers
+        and services are saved there and restored when it starts.
+        """
         self.verbose = verbose
+        self.budget = max(1, budget)
+        self.zerocopy = zerocopy
+        self.queue_limit = queue_limit
+        self.drop_oldest = drop_oldest
+        self.limits = dict(limits or {})
+        self.weights = tuple(weights or self.PRIORITY_WEIGHTS)
+        self.routing = routing
+        self.routes = dict(routes or {})
+        self.name = name
+        self.peers = []
+        self.forwarded = {}
         self.services = {}
         self.workers = {}
-        self.waiting = []
-        self.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
+        self.waiting = {}
+        now = time.time()
+        self.purge_at = now + 1e-3*self.HEARTBEAT_INTERVAL
+        self.timers = TimerWheel(1e-3*self.TIMER_RESOLUTION, now=now)
         self.ctx = zmq.Context()
-        self.socket = self.ctx.socket(zmq.ROUTER)
+        self.socket = self.ctx.socket(self.socket_type)
         self.socket.linger = 0
+        if self.socket_type == zmq.ROUTER:
+            # Workers keep their identity when they reconnect
+            self.socket.router_handover = 1
         self.poller = zmq.Poller()
         self.poller.register(self.socket, zmq.POLLIN)
         self.log = utils.logger(f'{name}.broker')
+        if snapshot is not None:
+            self.snapshot = snapshot
+            self.restore()
+        if journal is not None:
+            self.journal = Journal(journal, fsync)
+            self.replay()
 
     # ---------------------------------------------------------------------
 
     def mediate(self):
         """Main broker work happens here"""
         while True:
+            # Sleep no longer than the next housekeeping deadline
+            now = time.time()
+            wakeup = self.purge_at
+            if self.timers:
+                wakeup = min(wakeup, self.timers.next_at())
+            if self.state is not None:
+                wakeup = min(wakeup, self.advertise_at)
             try:
-                items = self.poller.poll(self.HEARTBEAT_INTERVAL)
+                items = dict(self.poller.poll(max(0, 1e3*(wakeup - now))))
             except KeyboardInterrupt:
                 break  # Interrupted
-            if items:
-                msg = self.socket.recv_multipart()
-                if self.verbose:
-                    self.log.info("I: received message:")
-                    dump(msg)
-
-                sender = msg.pop(0)
-                empty = msg.pop(0)
-                assert empty == b''
-                header = msg.pop(0)
-
-                if (MDP.C_CLIENT == header):
-                    self.process_client(sender, msg)
-                elif (MDP.W_WORKER == header):
-                    self.process_worker(sender, msg)
-                else:
-                    self.log.error("E: invalid message:")
-                    dump(msg)
-
-            self.purge_workers()
-            self.send_heartbeats()
+            if self.socket in items:
+                self.drain()
+            for peer in self.peers:
+                if peer.state in items:
+                    self.process_state(peer)
+                if peer.socket in items:
+                    self.process_peer(peer)
+
+            # Housekeeping runs on timers, not per message
+            now = time.time()
+            self.send_heartbeats(now)
+            if self.journal is not None:
+                self.journal.commit()
+            if now > self.purge_at:
+                self.purge_forwarded()
+                # Bounded queues should not fill up with dead requests
+                for service in self.services.values():
+                    if service.limit and service.requests:
+                        self.expire(service, now)
+                if self.journal is not None:
+                    self.journal.compact()
+                if self.snapshot is not None and self.changed:
+                    self.save()
+                self.purge_at = now + 1e-3*self.HEARTBEAT_INTERVAL
+            if self.state is not None and now > self.advertise_at:
+                self.advertise()
+
+    def drain(self):
+        """Process ready messages, up to budget, then flush replies."""
+        self.outbox = []
+        try:
+            for _ in range(self.budget):
+                try:
+                    msg = self.socket.recv_multipart(
+                        zmq.NOBLOCK, copy=not self.zerocopy
+                    )
+                except zmq.Again:
+                    break
+                self.process(msg)
+        finally:
+            self.flush()
+
+    def process(self, msg):
+        """Route a single message from a client or worker."""
+        if self.verbose:
+            self.log.info("I: received message:")
+            dump(msg)
+
+        if self.zerocopy:
+            # Only the routing envelope and MDP headers are ever read,
+            # bodies stay in the frames they arrived in.
+            msg[:4] = [frame.bytes for frame in msg[:4]]
+
+        sender = msg.pop(0)
+        empty = msg.pop(0)
+        assert empty == b''
+        header = msg.pop(0)
+
+        if (MDP.C_CLIENT == header) or (MDP.C_CLIENT_X == header):
+            self.process_client(sender, msg, header)
+        elif (MDP.W_WORKER == header):
+            self.process_worker(sender, msg)
+        else:
+            self.log.error("E: invalid message:")
+            dump(msg)
+
+    def send(self, msg):
+        """Send message, or hold it in the outbox while draining."""
+        if self.outbox is None:
+            self.socket.send_multipart(msg)
+        else:
+            self.outbox.append(msg)
+
+    def flush(self):
+        """Send all messages held in the outbox."""
+        outbox, self.outbox = self.outbox, None
+        # Write frames directly, send_multipart re-checks every frame
+        send, more = self.socket.send, int(zmq.SNDMORE)
+        for msg in outbox:
+            for frame in msg[:-1]:
+                send(frame, more)
+            send(msg[-1])
 
     def destroy(self):
-        """Disconnect all workers, destroy context."""
-        while self.workers:
-            self.delete_worker(self.workers[0], True)
+        """Disconnect all workers, destroy context.
+        With a snapshot, workers are saved instead and left connected,
+        so they carry on with their requests once we restart.
+        """
+        if self.snapshot is not None:
+            self.save()
+        else:
+            for worker in list(self.workers.values()):
+                self.delete_worker(worker, True)
+        if self.journal is not None:
+            self.journal.close()
         self.ctx.destroy(0)
 
-    def process_client(self, sender, msg):
+    def replay(self):
+        """Queue the requests left in the journal by our last run."""
+        requests = self.journal.replay()
+        for id, name, msg in requests:
+            props = properties(msg[1]) if len(msg[1]) else None
+            request = Request(msg, props)
+            request.queued, request.id = time.time(), id
+            self.require_service(name).requests.append(request)
+        if requests:
+            self.log.info("I: replayed %d queued requests", len(requests))
+
+    def save(self):
+        """Snapshot the worker registry, replacing the last one."""
+        registry = dict(
+            services=list(self.services),
+            workers=[
+                [worker.address, worker.service.name, worker.credit]
+                for worker in self.workers.values()
+                if worker.service is not None
+            ]
+        )
+        with open(self.snapshot + '.tmp', 'wb') as f:
+            f.write(codec.pack(registry))
+        os.replace(self.snapshot + '.tmp', self.snapshot)
+        self.changed = False
+
+    def restore(self):
+        """Load the worker registry saved by our last run.
+        Workers keep their identity across our restart, so probe them
+        until they answer rather than wait for them to re-register.
+        """
+        if not os.path.exists(self.snapshot):
+            return
+        with open(self.snapshot, 'rb') as f:
+            registry = codec.unpack(f.read())
+        for name in registry['services']:
+            self.require_service(name)
+        now = time.time()
+        for address, name, credit in registry['workers']:
+            worker = self.require_worker(address)
+            worker.service = self.require_service(name)
+            worker.service.workers += 1
+            worker.service.strategy.add(worker)
+            worker.credit = credit
+            worker.probing = True
+            worker.heartbeat_at = now
+            self.timers.schedule(worker.identity, now)
+        self.log.info(
+            "I: restored %d services and %d workers",
+            len(registry['services']), len(registry['workers'])
+        )
+
+    def process_client(self, sender, msg, header=MDP.C_CLIENT):
         """Process a request coming from a client."""
         assert len(msg) >= 2  # Service name + body
         service = msg.pop(0)
-        # Set reply return address to client sender
-        msg = [sender, b''] + msg
+        # Set reply return address to client sender, extended clients
+        # keep their properties in the envelope so the worker echoes them
+        props = None
+        if (MDP.C_CLIENT_X == header):
+            frame = msg.pop(0)
+            props = properties(frame)
+            msg = [sender, frame, b''] + msg
+        else:
+            msg = [sender, b''] + msg
         if service.startswith(self.INTERNAL_SERVICE_PREFIX):
             self.service_internal(service, msg)
         else:
-            self.dispatch(self.require_service(service), msg)
+            self.dispatch(self.require_service(service), Request(msg, props))
 
     def process_worker(self, sender, msg):
         """Process message sent to us by a worker."""
@@ -142,25 +549,44 @@ class MajorDomoBroker(object):
 
         worker = self.require_worker(sender)
 
+        if worker.probing and (MDP.W_READY == command):
+            # Restored, but it re-registered anyway, so start afresh
+            self.delete_worker(worker, False)
+            worker = self.require_worker(sender)
+            worker_ready = False
+
         if (MDP.W_READY == command):
             assert len(msg) >= 1  # At least, a service name
-            service = msg.pop(0)
+            service = frame_bytes(msg.pop(0))
+            # Optional credit, how many requests the worker prefetches
+            if msg:
+                worker.credit = max(1, int(frame_bytes(msg.pop(0))))
             # Not first command in session or Reserved service name
             if (worker_ready or service.startswith(self.INTERNAL_SERVICE_PREFIX)):
                 self.delete_worker(worker, True)
             else:
                 # Attach worker to service and mark as idle
                 worker.service = self.require_service(service)
+                worker.service.workers += 1
+                worker.service.strategy.add(worker)
+                self.changed = True
                 self.worker_waiting(worker)
 
         elif (MDP.W_REPLY == command):
             if (worker_ready):
+                service, now = worker.service, time.time()
+                service.replied += 1
+                if worker.credit > 1:
+                    tag = frame_bytes(msg.pop(0))
+                    request = worker.outstanding.pop(tag, None)
+                    if request is not None:
+                        service.times.add(now - request.sent)
+                elif worker.sent_at is not None:
+                    service.times.add(now - worker.sent_at)
                 # Remove & save client return envelope and insert the
                 # protocol header and service name, then rewrap envelope.
-                client = msg.pop(0)
-                empty = msg.pop(0)  # ?
-                msg = [client, b'', MDP.C_CLIENT, worker.service.name] + msg
-                self.socket.send_multipart(msg)
+                envelope, msg = unwrap(msg)
+                self.send_to_client(envelope, worker.service.name, msg)
                 self.worker_waiting(worker)
             else:
                 self.delete_worker(worker, True)
@@ -168,6 +594,8 @@ class MajorDomoBroker(object):
         elif (MDP.W_HEARTBEAT == command):
             if (worker_ready):
                 worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
+                if worker.probing:
+                    self.worker_waiting(worker)  # Back after our restart
             else:
                 self.delete_worker(worker, True)
 
@@ -183,8 +611,18 @@ class MajorDomoBroker(object):
         if disconnect:
             self.send_to_worker(worker, MDP.W_DISCONNECT, None, None)
 
+        self.waiting.pop(worker.identity, None)
+        self.timers.cancel(worker.identity)
+        self.changed = True
         if worker.service is not None:
-            worker.service.waiting.remove(worker)
+            worker.service.waiting.pop(worker.identity, None)
+            worker.service.workers -= 1
+            worker.service.strategy.remove(worker)
+            # Hand requests it never answered to the next worker
+            while worker.outstanding:
+                tag, request = worker.outstanding.popitem()
+                worker.service.requests.appendleft(request)
+                self.persist(worker.service, request)
         self.workers.pop(worker.identity)
 
     def require_worker(self, address):
@@ -195,6 +633,8 @@ class MajorDomoBroker(object):
         if (worker is None):
             worker = Worker(identity, address, self.HEARTBEAT_EXPIRY)
             self.workers[identity] = worker
+            worker.heartbeat_at = self.stagger()
+            self.timers.schedule(identity, worker.heartbeat_at)
             if self.verbose:
                 self.log.info("I: registering new worker: %s", identity)
 
@@ -205,7 +645,9 @@ class MajorDomoBroker(object):
         assert (name is not None)
         service = self.services.get(name)
         if (service is None):
-            service = Service(name)
+            limit = self.limits.get(name, self.queue_limit)
+            strategy = STRATEGIES[self.routes.get(name, self.routing)]
+            service = Service(name, limit, self.weights, strategy())
             self.services[name] = service
 
         return service
@@ -219,56 +661,355 @@ class MajorDomoBroker(object):
 
     def service_internal(self, service, msg):
         """Handle internal service according to 8/MMI specification"""
-        returncode = "501"
-        if "mmi.service" == service:
-            name = msg[-1]
-            returncode = "200" if name in self.services else "404"
-        msg[-1] = returncode
-
-        # insert the protocol header and service name after the routing envelope ([client, ''])
-        msg = msg[:2] + [MDP.C_CLIENT, service] + msg[2:]
-        self.socket.send_multipart(msg)
-
-    def send_heartbeats(self):
-        """Send heartbeats to idle workers if it's time"""
-        if (time.time() > self.heartbeat_at):
-            for worker in self.waiting:
-                self.send_to_worker(worker, MDP.W_HEARTBEAT, None, None)
+        envelope, msg = unwrap(msg)
+        name = frame_bytes(msg[-1])
+        returncode = MDP.R_NOT_IMPLEMENTED
+        if b"mmi.service" == service:
+            # Available if some worker, here or at a peer, can serve it
+            known = self.services.get(name)
+            available = known is not None and known.workers > 0
+            if available or self.require_peer(name) is not None:
+                returncode = MDP.R_OK
+            else:
+                returncode = MDP.R_NOT_FOUND
+        elif b"mmi.stats" == service:
+            returncode, msg = self.stats(name), msg[:-1]
+        elif b"mmi.workers" == service:
+            returncode, msg = self.worker_stats(name), msg[:-1]
+        if isinstance(returncode, bytes):
+            msg[-1:] = [returncode]
+        else:
+            msg += [MDP.R_OK, codec.pack(returncode)]
+        self.send_to_client(envelope, service, msg)
 
-            self.heartbeat_at = time.time() + 1e-3*self.HEARTBEAT_INTERVAL
+    def stats(self, name):
+        """mmi.stats, counters and latency histograms for the service
+        called name, or for every service when name is empty.
+        Behind a sharded router, ask for one service at a time.
+        """
+        if name:
+            service = self.services.get(name)
+            if service is None:
+                return MDP.R_NOT_FOUND
+            return service.stats()
+        return dict(
+            name=self.name,
+            time=time.time(),
+            workers=len(self.workers),
+            idle=len(self.waiting),
+            services=dict(
+                (key.decode('utf-8'), service.stats())
+                for key, service in self.services.items()
+            )
+        )
 
-    def purge_workers(self):
-        """Look for & kill expired workers.
-        Workers are oldest to most recent, so we stop at the first alive worker.
+    def worker_stats(self, name):
+        """mmi.workers, the workers of the service called name, or of
+        every service when name is empty.
         """
-        while self.waiting:
-            w = self.waiting[0]
-            if w.expiry < time.time():
-                self.log.info("I: deleting expired worker: %s", w.identity)
-                self.delete_worker(w, False)
-                self.waiting.pop(0)
+        if name and name not in self.services:
+            return MDP.R_NOT_FOUND
+        now = time.time()
+        return [
+            dict(
+                identity=worker.identity.decode('utf-8'),
+                service=worker.service.name.decode('utf-8'),
+                credit=worker.credit,
+                outstanding=len(worker.outstanding),
+                idle=worker.identity in self.waiting,
+                expiry=worker.expiry - now
+            )
+            for worker in self.workers.values()
+            if worker.service is not None
+            and (not name or worker.service.name == name)
+        ]
+
+    def stagger(self):
+        """When a new worker's heartbeat timer first fires.
+        Each worker gets the next phase in a golden ratio sequence, so
+        however many join at once their heartbeats spread evenly across
+        the interval rather than all landing on the same tick.
+        """
+        interval = 1e-3*self.HEARTBEAT_INTERVAL
+        self.phase = (self.phase + self.PHASE_STEP) % 1.0
+        now = time.time()
+        start = now - now % interval + self.phase*interval
+        return start if start > now else start + interval
+
+    def send_heartbeats(self, now):
+        """Run worker heartbeat timers that are due.
+        Workers that should be talking to us, the idle ones and those
+        with requests in flight under credit, are deleted once they go
+        quiet, and get a heartbeat otherwise. A single-credit worker busy
+        with a request is left alone. A tick only touches the workers
+        whose turn it is.
+        """
+        for identity in self.timers.advance(now):
+            worker = self.workers.get(identity)
+            if worker is None:
+                continue
+            if identity in self.waiting or worker.outstanding \
+                    or worker.probing:
+                if worker.expiry < now:
+                    self.purge_worker(worker)
+                    continue
+                self.send_to_worker(worker, MDP.W_HEARTBEAT, None, None)
+            if worker.probing:
+                worker.heartbeat_at = now + 1e-3*self.PROBE_INTERVAL
             else:
-                break
+                worker.heartbeat_at += 1e-3*self.HEARTBEAT_INTERVAL
+            self.timers.schedule(identity, worker.heartbeat_at)
+
+    def purge_worker(self, worker):
+        """Kill an expired worker, requeueing its requests in flight."""
+        self.log.info("I: deleting expired worker: %s", worker.identity)
+        self.delete_worker(worker, False)
 
     def worker_waiting(self, worker):
         """This worker is now waiting for work."""
-        # Queue to broker and service waiting lists
-        self.waiting.append(worker)
-        worker.service.waiting.append(worker)
+        # Queue to broker and service waiting lists, a worker with
+        # requests in flight only waits on its service for more.
         worker.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
+        if worker.probing:
+            worker.probing = False
+            worker.heartbeat_at = self.stagger()
+            self.timers.schedule(worker.identity, worker.heartbeat_at)
+        if not worker.outstanding:
+            self.waiting[worker.identity] = worker
+        worker.service.waiting[worker.identity] = worker
         self.dispatch(worker.service, None)
 
-    def dispatch(self, service, msg):
+    def dispatch(self, service, request):
         """Dispatch requests to waiting workers as possible"""
         assert (service is not None)
-        if msg is not None:  # Queue message if any
-            service.requests.append(msg)
-        self.purge_workers()
+        now = time.time()
+        queued = None  # The new request, if it joined the queue
+        if request is not None:  # Queue request if any
+            request.queued = now
+            if service.limit and len(service.requests) >= service.limit:
+                self.expire(service, now, sweep=False)
+            if service.limit and len(service.requests) >= service.limit:
+                # Full, answer busy now rather than time out later
+                shed = request
+                if self.drop_oldest:
+                    shed = service.requests.shed(request)
+                    if shed is not request:
+                        queued = request
+                self.reject(service, shed)
+            else:
+                service.requests.append(request)
+                queued = request
         while service.waiting and service.requests:
-            msg = service.requests.pop(0)
-            worker = service.waiting.pop(0)
-            self.waiting.remove(worker)
-            self.send_to_worker(worker, MDP.W_REQUEST, None, msg)
+            request = service.requests.popleft()
+            if request.expired(now):
+                service.expired += 1  # Nobody is waiting for the reply
+                self.settle(request)
+                if request is queued:
+                    queued = None
+                continue
+            worker = service.strategy.select(service, request)
+            identity = worker.identity
+            if worker.expiry < now and (
+                    identity in self.waiting or worker.outstanding):
+                # Gone quiet since its timer last ran, try another
+                service.requests.appendleft(request)
+                self.purge_worker(worker)
+                continue
+            del service.waiting[identity]
+            self.waiting.pop(identity, None)
+            self.settle(request)
+            service.waits.add(now - request.queued)
+            service.dispatched += 1
+            request.sent = worker.sent_at = now
+            if worker.credit > 1:
+                # Tag the request so the reply settles it, and keep the
+                # worker at the back of the line while it has credit.
+                worker.sequence += 1
+                tag = b'%x' % worker.sequence
+                worker.outstanding[tag] = request
+                if len(worker.outstanding) < worker.credit:
+                    service.waiting[identity] = worker
+                self.send_to_worker(worker, MDP.W_REQUEST, tag, request.msg)
+            else:
+                self.send_to_worker(worker, MDP.W_REQUEST, None, request.msg)
+        if queued is not None and queued.sent is None:
+            self.persist(service, queued)  # Still queued, make it durable
+        if service.requests and self.peers:
+            self.forward(service)
+
+    def persist(self, service, request):
+        """Log a queued request to the journal, if we keep one."""
+        if self.journal is not None and request.id is None:
+            request.id = self.journal.append(service.name, request.msg)
+
+    def settle(self, request):
+        """The request has left its queue, so forget it in the journal."""
+        if request.id is not None:
+            self.journal.ack(request.id)
+            request.id = None
+
+    def expire(self, service, now, sweep=True):
+        """Drop queued requests whose clients have given up, all of them
+        or, without sweep, those at the head of the queue.
+        """
+        if sweep:
+            dropped = service.requests.expire(now)
+        else:
+            dropped = service.requests.trim(now)
+        service.expired += len(dropped)
+        for request in dropped:
+            self.settle(request)
+
+    def reject(self, service, request):
+        """Shed a request, telling the client the service is busy."""
+        service.rejected += 1
+        self.settle(request)
+        envelope, msg = unwrap(request.msg)
+        self.send_to_client(envelope, service.name, [MDP.R_BUSY])
+
+    def send_to_client(self, envelope, service, msg):
+        """Send reply to client, rewrapping its return envelope."""
+        if len(envelope) > 1:
+            msg = [envelope[0], b'', MDP.C_CLIENT_X, service, envelope[1]] + msg
+        else:
+            msg = [envelope[0], b'', MDP.C_CLIENT, service] + msg
+        self.send(msg)
+
+    # ---------------------------------------------------------------------
+
+    def federate(self, endpoint):
+        """Advertise our idle capacity to peers on endpoint."""
+        self.state = self.ctx.socket(zmq.PUB)
+        self.state.linger = 0
+        self.state.bind(endpoint)
+        self.advertise_at = time.time()
+        self.log.info("I: advertising capacity at %s", endpoint)
+
+    def peer(self, endpoint, state):
+        """Peer with the broker at endpoint, advertising on state."""
+        socket = self.ctx.socket(zmq.DEALER)
+        socket.linger = 0
+        socket.connect(endpoint)
+        sub = self.ctx.socket(zmq.SUB)
+        sub.linger = 0
+        sub.setsockopt(zmq.SUBSCRIBE, b'')
+        sub.connect(state)
+        self.poller.register(socket, zmq.POLLIN)
+        self.poller.register(sub, zmq.POLLIN)
+        self.peers.append(Peer(endpoint, socket, sub))
+        self.log.info("I: peering with broker at %s", endpoint)
+
+    def advertise(self):
+        """Publish idle workers per service to our peers."""
+        capacity = dict(
+            (name.decode('utf-8'), len(service.waiting))
+            for name, service in self.services.items()
+        )
+        self.state.send_multipart(
+            [self.name.encode('utf-8'), codec.pack(capacity)]
+        )
+        self.advertise_at = time.time() + 1e-3*self.ADVERTISE_INTERVAL
+
+    def process_state(self, peer):
+        """Update a peer's capacity, then use it for queued requests."""
+        while True:
+            try:
+                name, capacity = peer.state.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            peer.capacity = dict(
+                (service.encode('utf-8'), count)
+                for service, count in codec.unpack(capacity).items()
+            )
+            peer.expiry = time.time() + 1e-3*self.HEARTBEAT_EXPIRY
+
+        for name, count in peer.capacity.items():
+            service = self.services.get(name)
+            if count and service is not None and service.requests:
+                self.dispatch(service, None)
+
+    def require_peer(self, name):
+        """Finds the live peer with most idle workers for a service."""
+        best, most = None, 0
+        now = time.time()
+        for peer in self.peers:
+            count = peer.capacity.get(name, 0)
+            if count > most and peer.expiry > now:
+                best, most = peer, count
+        return best
+
+    def forward(self, service):
+        """Hand queued requests to peers with idle workers for them."""
+        while service.requests:
+            peer = self.require_peer(service.name)
+            if peer is None:
+                break
+            request = service.requests.peek()
+            if request.expired(time.time()):
+                service.requests.popleft()
+                service.expired += 1
+                self.settle(request)
+                continue
+            props = request.properties or {}
+            if 'via' in props:
+                break  # Already forwarded once, never bounce it on
+
+            envelope, body = unwrap(request.msg)
+            props = dict(props, id=self.sequence + 1, via=self.name)
+            try:
+                peer.socket.send_multipart(
+                    [b'', MDP.C_CLIENT_X, service.name, codec.pack(props)]
+                    + body, zmq.NOBLOCK
+                )
+            except zmq.Again:
+                peer.expiry = 0  # Peer is not keeping up, stop using it
+                continue
+
+            service.requests.popleft()
+            service.forwarded += 1
+            self.settle(request)
+            peer.capacity[service.name] -= 1
+            self.sequence += 1
+            self.forwarded[self.sequence] = (
+                time.time() + 1e-3*self.HEARTBEAT_EXPIRY, envelope
+            )
+
+    def process_peer(self, peer):
+        """Return replies from a peer to the clients that asked, each
+        one giving back the capacity its request used.
+        """
+        while True:
+            try:
+                msg = peer.socket.recv_multipart(
+                    zmq.NOBLOCK, copy=not self.zerocopy
+                )
+            except zmq.Again:
+                break
+            # [empty, header, service, properties, body...]
+            service = frame_bytes(msg[2])
+            props = codec.unpack(frame_bytes(msg[3]))
+            forwarded = self.forwarded.pop(props.get('id'), None)
+            if forwarded is None:
+                continue  # Too late, the client has given up
+            expiry, envelope = forwarded
+            self.send_to_client(envelope, service, msg[4:])
+            # The worker it took is free again, no need to wait for the
+            # next advert to use it
+            if service in peer.capacity:
+                peer.capacity[service] += 1
+                queued = self.services.get(service)
+                if queued is not None and queued.requests:
+                    self.forward(queued)
+
+    def purge_forwarded(self):
+        """Forget requests our peers never answered."""
+        now = time.time()
+        while self.forwarded:
+            k = next(iter(self.forwarded))
+            if self.forwarded[k][0] < now:
+                del self.forwarded[k]
+            else:
+                break
 
     def send_to_worker(self, worker, command, option, msg=None):
         """Send message to worker.
@@ -290,4 +1031,4 @@ class MajorDomoBroker(object):
             self.log.info("I: sending %r to worker", command)
             dump(msg)
 
-        self.socket.send_multipart(msg)
+        self.send(msg)
@@ -0,0 +1,58 @@
+"""Circuit breakers for the services a client calls"""
+
+CLOSED = 'closed'  # Calls go through
+OPEN = 'open'  # Calls fail fast until the next probe
+HALF_OPEN = 'half-open'  # The probe passed, one call is on trial
+
+
+class Circuit(object):
+    """Circuit breaker for one service.
+    Failures in a row open it, and while open calls fail at once. Every
+    cooldown a probe asks the broker whether the service has workers,
+    and if it does the next call goes through to close the circuit, or
+    open it again if it fails too.
+    """
+    THRESHOLD = 5  # Failures in a row that open the circuit
+    COOLDOWN = 1000  # msecs between probes while open
+
+    state = CLOSED
+    failures = 0  # Failures in a row
+    probe_at = 0  # When to probe next, while open
+    opened = 0  # Times the circuit opened
+    rejected = 0  # Calls failed fast
+
+    def due(self, now):
+        """Whether it is time to probe, claiming the probe if so."""
+        # A trial that never finished counts as open
+        if self.state != CLOSED and now >= self.probe_at:
+            self.probe_at = now + 1e-3*self.COOLDOWN
+            return True
+        return False
+
+    def trial(self):
+        self.state = HALF_OPEN
+
+    def success(self):
+        self.failures = 0
+        self.state = CLOSED
+
+    def failure(self, now, available=True):
+        """Count a failed call, opening at once if the service has no
+        workers, or once there are enough failures in a row.
+        """
+        self.failures += 1
+        if (not available or self.state != CLOSED
+                or self.failures >= self.THRESHOLD):
+            self.trip(now)
+
+    def trip(self, now):
+        if self.state != OPEN:
+            self.opened += 1
+        self.state = OPEN
+        self.probe_at = now + 1e-3*self.COOLDOWN
+
+    def stats(self):
+        return dict(
+            state=self.state, failures=self.failures,
+            opened=self.opened, rejected=self.rejected
+        )
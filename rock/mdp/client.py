@@ -4,29 +4,59 @@ Author: Min RK <benjaminrk@gmail.com>
 Based on Java example by Arkadiusz Orzechowski
 """
 
+import time
+import uuid
 import zmq
 
 from . import MDP
-from .zhelpers import dump
-from .. import utils
+from .zhelpers import dump, context
+from .stats import Histogram
+from .circuit import Circuit, CLOSED
+from .. import utils, msg as codec
 
 
 class MajorDomoClient(object):
     """Majordomo Protocol Client API, Python version.
       Implements the MDP/Worker spec at http:#rfc.zeromq.org/spec:7.
+    Timeouts follow the latencies seen for each service, and a call
+    still waiting past the usual p95 sends a hedged copy and takes
+    whichever reply comes first. Calls to a service that keeps failing
+    fail fast until mmi.service says it is back.
     """
     broker = None
     ctx = None
     client = None
+    identity = None  # Routing id, kept across reconnects and broker restarts
     poller = None
-    timeout = 2500
+    timeout = 2500  # Longest wait for one attempt, msecs
     retries = 3
     verbose = False
 
+    MIN_SAMPLES = 20  # Latencies seen before timeouts adapt
+    MIN_TIMEOUT = 50  # Shortest adaptive timeout, msecs
+    TIMEOUT_FACTOR = 4  # Adaptive timeout, in multiples of the p99
+    WINDOW = 1000  # Latencies kept at full weight, older ones decay
+    WIDEN_DECAY = 0.9  # A widened timeout shrinks by this per reply
+    HEDGE_RATIO = 0.05  # Hedged copies per call, at most
+    HEDGE_BURST = 10  # Hedges that can be saved up
+    PROBE_TIMEOUT = 250  # Wait for an mmi.service probe, msecs
+
+    sequence = 0  # last correlation id
+    latency = None  # Histogram of reply latencies by service
+    widened = None  # Timeout by service, doubled on each timed out attempt
+    circuits = None  # Circuit by service, may be shared by clients
+    hedges = 0  # Hedges we may send now, earned by calls
+    hedged = 0  # Hedged copies sent
+    reconnects = 0  # Times the broker was gone
+
     def __init__(self, broker, name, verbose=False):
         self.broker = broker
         self.verbose = verbose
-        self.ctx = zmq.Context()
+        self.latency = {}
+        self.widened = {}
+        self.circuits = {}
+        self.identity = uuid.uuid4().hex.encode('utf-8')
+        self.ctx = context()
         self.poller = zmq.Poller()
         self.log = utils.logger(f"{name}.client")
         self.reconnect_to_broker()
@@ -36,33 +66,115 @@ class MajorDomoClient(object):
         if self.client:
             self.poller.unregister(self.client)
             self.client.close()
-        self.client = self.ctx.socket(zmq.REQ)
+        self.client = self.ctx.socket(zmq.DEALER)
         self.client.linger = 0
+        self.client.identity = self.identity
         self.client.connect(self.broker)
         self.poller.register(self.client, zmq.POLLIN)
         if self.verbose:
             self.log.info("I: connecting to broker at %s...", self.broker)
 
-    def send(self, service, request):
+    def timeouts(self, service):
+        """Attempt timeout and hedge delay for service, in seconds.
+        There is no hedge delay until enough replies have been seen.
+        """
+        latency = self.latency.get(service)
+        if latency is None or latency.count < self.MIN_SAMPLES:
+            return 1e-3*self.timeout, None
+        timeout = min(
+            max(self.TIMEOUT_FACTOR*latency.percentile(99),
+                1e-3*self.MIN_TIMEOUT, self.widened.get(service, 0)),
+            1e-3*self.timeout
+        )
+        return timeout, latency.percentile(95)
+
+    def widen(self, service, timeout):
+        """Double the timeout of service after a timed out attempt, up
+        to the client's, so a service that slowed down is still heard.
+        """
+        timeout = min(2*timeout, 1e-3*self.timeout)
+        self.widened[service] = timeout
+        return timeout
+
+    def narrow(self, service):
+        """Let a widened timeout shrink back as replies come in time."""
+        timeout = self.widened.get(service)
+        if timeout is not None:
+            timeout *= self.WIDEN_DECAY
+            if timeout < 1e-3*self.MIN_TIMEOUT:
+                del self.widened[service]
+            else:
+                self.widened[service] = timeout
+
+    def observe(self, service, seconds):
+        latency = self.latency.get(service)
+        if latency is None:
+            latency = self.latency[service] = Histogram()
+        elif latency.count >= self.WINDOW:
+            latency.decay()
+        latency.add(seconds)
+
+    def send(self, service, request, priority=None, key=None):
         """Send request to broker and get reply by hook or crook.
         Takes ownership of request message and destroys it when sent.
         Returns the reply message or None if there was no reply.
+        The request carries the time we give up at, so the broker and the
+        worker can skip it once nobody is waiting for the reply, and
+        optionally its priority class (MDP.P_HIGH, P_NORMAL or P_LOW) and
+        a routing key, sending requests with the same key to the same
+        worker when the service routes by key.
+        A request is sent again when an attempt times out, and hedged
+        once if it is slower than the service's p95.
+        While the service's circuit is open the reply is MDP.R_NOT_FOUND,
+        without asking the broker.
         """
         if not isinstance(request, list):
             request = [request]
-        request = [MDP.C_CLIENT, service] + request
-        if self.verbose:
-            self.log.warn("I: send request to '%s' service: ", service)
-            dump(request)
-        reply = None
+        circuit = None
+        if not service.startswith(b'mmi.'):
+            circuit = self.circuits.get(service)
+            if circuit is None:
+                circuit = self.circuits.setdefault(service, Circuit())
+            if not self.admit(service, circuit):
+                circuit.rejected += 1
+                return [MDP.R_NOT_FOUND]
+        timeout, hedge = self.timeouts(service)
+        self.hedges = min(self.HEDGE_BURST, self.hedges + self.HEDGE_RATIO)
+        start = time.time()
+        # Each retry waits twice as long as the one before
+        budget = sum(
+            min(timeout*2**k, 1e-3*self.timeout)
+            for k in range(self.retries)
+        )
+        props = dict(deadline=start + budget)
+        if priority is not None:
+            props['priority'] = priority
+        if key is not None:
+            props['key'] = key
 
-        retries = self.retries
-        while retries > 0:
-            self.client.send_multipart(request)
+        cids = set()  # Any copy's reply will do
+
+        def attempt():
+            self.sequence += 1
+            props['cid'] = self.sequence
+            cids.add(self.sequence)
+            msg = [b'', MDP.C_CLIENT_X, service, codec.pack(props)] + request
+            if self.verbose:
+                self.log.warn("I: send request to '%s' service: ", service)
+                dump(msg)
+            self.client.send_multipart(msg)
+
+        attempt()
+        retries = self.retries - 1
+        expires = start + timeout
+        hedge_at = None if hedge is None else start + hedge
+        while True:
+            now = time.time()
+            wake = expires if hedge_at is None else min(expires, hedge_at)
             try:
-                items = self.poller.poll(self.timeout)
+                items = self.poller.poll(max(0, 1e3*(wake - now)))
             except KeyboardInterrupt:
-                break  # interrupted
+                return  # interrupted
 
             if items:
                 msg = self.client.recv_multipart()
@@ -71,26 +183,75 @@ class MajorDomoClient(object):
                     dump(msg)
 
                 # Don't try to handle errors, just assert noisily
-                assert len(msg) >= 3
-
-                header = msg.pop(0)
-                assert MDP.C_CLIENT == header
+                assert len(msg) >= 5 and MDP.C_CLIENT_X == msg[1]
+                if codec.unpack(msg[3]).get('cid') not in cids:
+                    continue  # Late reply to an earlier call
+                reply = msg[4:]
+                if reply[-1:] not in ([MDP.R_BUSY], [MDP.R_TIMEOUT]):
+                    self.observe(service, time.time() - start)
+                    if retries == self.retries - 1:
+                        self.narrow(service)  # Answered on the first try
+                if circuit is not None:
+                    circuit.success()
+                return reply
 
-                reply_service = msg.pop(0)
-                assert service == reply_service
-
-                reply = msg
-                break
-            else:
-                if retries:
-                    self.log.warn("W: no reply, reconnecting...")
-                    self.reconnect_to_broker()
-                else:
-                    self.log.warn("W: permanent error, abandoning")
+            now = time.time()
+            if now >= expires:
+                if not retries:
                     break
+                self.log.warn("W: no reply, retrying...")
                 retries -= 1
+                timeout = self.widen(service, timeout)
+                expires = now + timeout
+                attempt()
+            elif hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                if self.hedges >= 1:
+                    self.hedges -= 1
+                    self.hedged += 1
+                    attempt()
 
-        return reply
+        self.log.warn("W: permanent error, abandoning")
+        # The service took at least this long, the next calls wait longer
+        self.observe(service, time.time() - start)
+        self.widen(service, timeout)
+        code = self.probe(service, timeout)
+        if code is None:
+            self.log.warn("W: broker is gone, reconnecting...")
+            self.reconnects += 1
+            self.reconnect_to_broker()
+        if circuit is not None:
+            circuit.failure(time.time(), code == MDP.R_OK)
+
+    def admit(self, service, circuit):
+        """Whether a call may go to service, probing it when due if its
+        circuit is open.
+        """
+        if circuit.state == CLOSED:
+            return True
+        if not circuit.due(time.time()):
+            return False
+        if self.probe(service, 1e-3*self.PROBE_TIMEOUT) == MDP.R_OK:
+            circuit.trial()
+            return True
+        return False
+
+    def probe(self, service, timeout):
+        """mmi.service return code for service, or None if the broker
+        did not answer in time.
+        """
+        self.sequence += 1
+        cid = self.sequence
+        props = codec.pack(dict(cid=cid, deadline=time.time() + timeout))
+        self.client.send_multipart(
+            [b'', MDP.C_CLIENT_X, b'mmi.service', props, service]
+        )
+        expires = time.time() + timeout
+        while self.poller.poll(max(0, 1e3*(expires - time.time()))):
+            msg = self.client.recv_multipart()
+            if codec.unpack(msg[3]).get('cid') == cid:
+                return msg[-1]
+        return None
 
     def destroy(self):
-        self.context.destroy()
+        self.client.close()
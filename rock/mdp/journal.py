@@ -0,0 +1,247 @@
+"""
+Durable log of the requests queued in a broker
+Queued requests are appended to memory mapped segment files and
+acknowledged once they leave the queue. Syncs to disk are grouped, so
+many requests share one msync, and a restarted broker replays whatever
+was still queued. Old segments are deleted once all their requests are
+acknowledged, or compacted when only a few are left.
+"""
+
+import os
+import mmap
+import time
+import zlib
+import struct
+
+from .zhelpers import frame_bytes
+from .. import msg as codec
+
+#  Record types
+ENQUEUE = 1
+ACK = 2
+
+#  Record header: payload length, crc32, type, request id
+HEADER = struct.Struct('<IIBQ')
+
+#  When to sync appended records to disk
+FSYNC = ('always', 'batch', 'interval', 'never')
+
+
+class Segment(object):
+    """a memory mapped log file"""
+    number = 0  # Position in the log
+    path = None  # File path
+    map = None  # mmap of the whole file
+    size = 0  # File size
+    end = 0  # Where the next record goes
+    synced = 0  # Everything before this is on disk
+    ids = None  # request id -> (offset, length), not acknowledged yet
+    live = 0  # Bytes held by those requests
+
+    def __init__(self, number, path, size=0):
+        self.number = number
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.ids = {}
+
+    def add(self, id, offset, length):
+        self.ids[id] = (offset, length)
+        self.live += length
+
+    def discard(self, id):
+        offset, length = self.ids.pop(id)
+        self.live -= length
+
+    def payload(self, id):
+        offset, length = self.ids[id]
+        return self.map[offset + HEADER.size:offset + HEADER.size + length]
+
+    def write(self, kind, id, payload):
+        """Append a record, returns its offset."""
+        offset = self.end
+        crc = zlib.crc32(payload, zlib.crc32(struct.pack('<BQ', kind, id)))
+        end = offset + HEADER.size + len(payload)
+        self.map[offset:offset + HEADER.size] = HEADER.pack(
+            len(payload), crc, kind, id
+        )
+        self.map[offset + HEADER.size:end] = payload
+        self.end = end
+        return offset
+
+    def read(self, offset):
+        """Record at offset as (kind, id, payload, next offset), or None
+        at the end of the log or a torn write.
+        """
+        if offset + HEADER.size > self.size:
+            return None
+        length, crc, kind, id = HEADER.unpack_from(self.map, offset)
+        start = offset + HEADER.size
+        if kind not in (ENQUEUE, ACK) or start + length > self.size:
+            return None
+        payload = self.map[start:start + length]
+        if crc != zlib.crc32(payload, zlib.crc32(struct.pack('<BQ', kind, id))):
+            return None
+        return kind, id, payload, start + length
+
+    def sync(self):
+        if self.synced < self.end:
+            start = self.synced - self.synced % mmap.PAGESIZE
+            self.map.flush(start, self.end - start)
+            self.synced = self.end
+
+    def close(self):
+        self.map.close()
+
+
+class Journal(object):
+    """Append-only log of queued requests, in numbered segment files."""
+    SEGMENT_SIZE = 1 << 24  # bytes per segment file
+    SYNC_INTERVAL = 100  # msecs between syncs with fsync='interval'
+    COMPACT_RATIO = 0.25  # compact old segments with less live data
+
+    directory = None  # Where the segment files live
+    fsync = 'batch'  # Sync policy, one of FSYNC
+    segments = None  # Segments, oldest first
+    index = None  # request id -> Segment holding it, if not acknowledged
+    sequence = 0  # last request id
+    sync_at = 0  # When to sync next, with fsync='interval'
+
+    def __init__(self, directory, fsync='batch', segment_size=None):
+        if fsync not in FSYNC:
+            raise ValueError(f'fsync must be one of {", ".join(FSYNC)}')
+        self.directory = directory
+        self.fsync = fsync
+        if segment_size is not None:
+            self.SEGMENT_SIZE = segment_size
+        self.segments = []
+        self.index = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, number):
+        return os.path.join(self.directory, f'{number:012d}.log')
+
+    def replay(self):
+        """Open the log, returns the requests it still holds, in order,
+        as (id, service, msg).
+        """
+        names = sorted(
+            name for name in os.listdir(self.directory)
+            if name.endswith('.log')
+        )
+        pending = {}
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not os.path.getsize(path):
+                os.remove(path)  # Crashed while rolling
+                continue
+            segment = Segment(int(name[:-4]), path)
+            self.segments.append(segment)
+            offset = 0
+            record = segment.read(offset)
+            while record is not None:
+                kind, id, payload, end = record
+                self.sequence = max(self.sequence, id)
+                if kind == ENQUEUE:
+                    if id in self.index:  # Copied forward by compaction
+                        self.index[id].discard(id)
+                    pending[id] = payload
+                    self.index[id] = segment
+                    segment.add(id, offset, len(payload))
+                elif id in pending:
+                    del pending[id]
+                    self.index.pop(id).discard(id)
+                offset = end
+                record = segment.read(offset)
+            # Anything past the last good record is a torn write
+            segment.end = segment.synced = offset
+            segment.map[offset:] = bytes(segment.size - offset)
+        if not self.segments:
+            self.roll(0)
+        self.compact()
+        requests = []
+        for id in sorted(pending):
+            service, frames = codec.unpack(pending[id])
+            requests.append((id, service.encode('utf-8'), frames))
+        return requests
+
+    @property
+    def active(self):
+        return self.segments[-1]
+
+    def roll(self, size):
+        """Start a new segment with room for at least size bytes."""
+        if self.segments:
+            if self.fsync != 'never':
+                self.active.sync()
+            number = self.active.number + 1
+        else:
+            number = 0
+        self.segments.append(
+            Segment(number, self.path(number), max(size, self.SEGMENT_SIZE))
+        )
+
+    def write(self, kind, id, payload):
+        size = HEADER.size + len(payload)
+        if self.active.end + size > self.active.size:
+            self.roll(size)
+        segment = self.active
+        offset = segment.write(kind, id, payload)
+        if kind == ENQUEUE:
+            self.index[id] = segment
+            segment.add(id, offset, len(payload))
+        if self.fsync == 'always':
+            segment.sync()
+
+    def append(self, service, msg):
+        """Log a queued request, returns its id."""
+        self.sequence += 1
+        payload = codec.pack(
+            [service.decode('utf-8'), [frame_bytes(frame) for frame in msg]]
+        )
+        self.write(ENQUEUE, self.sequence, payload)
+        return self.sequence
+
+    def ack(self, id):
+        """Log that a request has left the queue."""
+        segment = self.index.pop(id, None)
+        if segment is not None:
+            segment.discard(id)
+            self.write(ACK, id, b'')
+
+    def commit(self):
+        """Group commit, sync whatever was appended if the policy says so."""
+        if self.fsync == 'batch':
+            self.active.sync()
+        elif self.fsync == 'interval':
+            now = time.time()
+            if now >= self.sync_at:
+                self.active.sync()
+                self.sync_at = now + 1e-3*self.SYNC_INTERVAL
+
+    def compact(self):
+        """Delete old segments with nothing left in them, and copy the
+        last few requests of mostly acknowledged ones forward first.
+        """
+        while len(self.segments) > 1:
+            segment = self.segments[0]
+            if segment.ids:
+                if segment.live > self.COMPACT_RATIO * segment.end:
+                    break
+                for id in sorted(segment.ids):
+                    self.write(ENQUEUE, id, segment.payload(id))
+                self.active.sync()
+            self.segments.pop(0)
+            segment.close()
+            os.remove(segment.path)
+
+    def close(self):
+        for segment in self.segments:
+            segment.sync()
+            segment.close()
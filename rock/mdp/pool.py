@@ -0,0 +1,106 @@
+"""
+Client sockets shared by the proxies of a process
+Every proxy for a broker goes through the same few sockets, so building
+more proxies adds no connections or I/O threads. Blocking clients are
+checked out for a call and returned, pipelined clients carry any number
+of calls at once, so there is one of them per thread.
+"""
+
+import os
+import threading
+import collections
+
+
+class ClientPool(object):
+    """Blocking clients to one broker, checked out one call at a time."""
+    client = None  # Client class
+    broker = None
+    verbose = False
+    idle = None  # Clients ready for a call
+    circuits = None  # Circuit breakers by service, shared by the clients
+    size = 0  # Clients made so far, idle or checked out
+    lock = None
+
+    def __init__(self, client, broker, verbose=False):
+        self.client = client
+        self.broker = broker
+        self.verbose = verbose
+        self.idle = collections.deque()
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def get(self):
+        return self
+
+    def checkout(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            self.size += 1
+        client = self.client(self.broker, 'rpc', self.verbose)
+        client.circuits = self.circuits
+        return client
+
+    def checkin(self, client):
+        with self.lock:
+            self.idle.append(client)
+
+    def send(self, service, request, priority=None, key=None):
+        client = self.checkout()
+        try:
+            return client.send(service, request, priority, key)
+        finally:
+            self.checkin(client)
+
+    def destroy(self):
+        with self.lock:
+            while self.idle:
+                self.idle.pop().destroy()
+            self.size = 0
+
+
+class ThreadClients(threading.local):
+    """One pipelined client to a broker for each thread."""
+    instance = None
+
+    def __init__(self, client, broker, verbose=False):
+        self.client = client
+        self.broker = broker
+        self.verbose = verbose
+
+    def get(self):
+        if self.instance is None:
+            self.instance = self.client(self.broker, 'rpc', self.verbose)
+        return self.instance
+
+
+_pools = {}  # (client class, broker) -> ClientPool or ThreadClients
+_pid = None  # Process the pools belong to, a forked child starts afresh
+_lock = threading.Lock()
+
+
+def pool(cls, broker, verbose=False):
+    """Shared clients of class cls to broker, a ClientPool for blocking
+    clients, or ThreadClients for pipelined ones. Either one's get()
+    gives the client to call with in the current thread.
+    """
+    global _pid
+    with _lock:
+        if _pid != os.getpid():
+            _pools.clear()
+            _pid = os.getpid()
+        pool = _pools.get((cls, broker))
+        if pool is None:
+            if getattr(cls, 'pipelined', False):
+                pool = ThreadClients(cls, broker, verbose)
+            else:
+                pool = ClientPool(cls, broker, verbose)
+            _pools[(cls, broker)] = pool
+    return pool
+
+
+def client(cls, broker, verbose=False):
+    """Shared client of class cls to broker, a ClientPool for blocking
+    clients, or this thread's client for pipelined ones.
+    """
+    return pool(cls, broker, verbose).get()
@@ -0,0 +1,54 @@
+"""Consistent hash ring used to map service names to owners"""
+
+import bisect
+import hashlib
+
+from .. import msg as codec
+
+
+class HashRing(object):
+    """Consistent hash ring with virtual nodes.
+    Adding or removing a node only moves the keys that node owns.
+    """
+    replicas = 64  # virtual nodes per node
+
+    def __init__(self, nodes=(), replicas=None):
+        if replicas is not None:
+            self.replicas = replicas
+        self.hashes = []  # sorted virtual node hashes
+        self.owners = {}  # virtual node hash -> node
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.hashes) // self.replicas
+
+    @staticmethod
+    def hash(key):
+        # Keys come from clients, anything but text is hashed packed
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        elif not isinstance(key, bytes):
+            key = codec.canonical(key)
+        return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+    def add(self, node):
+        for k in range(self.replicas):
+            h = self.hash(f'{node}#{k}')
+            if h not in self.owners:
+                bisect.insort(self.hashes, h)
+            self.owners[h] = node
+
+    def remove(self, node):
+        for k in range(self.replicas):
+            h = self.hash(f'{node}#{k}')
+            if self.owners.get(h) == node:
+                del self.owners[h]
+                self.hashes.pop(bisect.bisect_left(self.hashes, h))
+
+    def get(self, key):
+        """Returns the node owning key, or None if the ring is empty."""
+        if not self.hashes:
+            return None
+        k = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.owners[self.hashes[k]]
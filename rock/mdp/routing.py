@@ -0,0 +1,74 @@
+"""Strategies a broker uses to pick the worker a request goes to"""
+
+from abc import ABCMeta, abstractmethod
+
+from .ring import HashRing
+
+
+class Strategy(metaclass=ABCMeta):
+    """Picks one of a service's waiting workers for a request.
+    The broker keeps one instance per service and tells it about workers
+    joining and leaving the service.
+    """
+
+    def add(self, worker):
+        pass
+
+    def remove(self, worker):
+        pass
+
+    @abstractmethod
+    def select(self, service, request):
+        pass
+
+
+class LeastRecentlyUsed(Strategy):
+    """The worker waiting the longest, the plain MDP behaviour"""
+
+    def select(self, service, request):
+        return next(iter(service.waiting.values()))
+
+
+class ConsistentHash(Strategy):
+    """Requests with the same routing key go to the same worker while it
+    can take them, so its in-process caches stay hot. Requests without a
+    key, or whose worker is busy, go to the longest waiting worker.
+    """
+
+    def __init__(self):
+        self.ring = HashRing()
+
+    def add(self, worker):
+        self.ring.add(worker.identity)
+
+    def remove(self, worker):
+        self.ring.remove(worker.identity)
+
+    def select(self, service, request):
+        if request.key is not None:
+            worker = service.waiting.get(self.ring.get(request.key))
+            if worker is not None:
+                return worker
+        return next(iter(service.waiting.values()))
+
+
+class LeastOutstanding(Strategy):
+    """The waiting worker with the fewest requests in flight, for workers
+    taking several requests at once. Stops at the first idle worker.
+    """
+
+    def select(self, service, request):
+        best = None
+        for worker in service.waiting.values():
+            if not worker.outstanding:
+                return worker
+            if best is None or len(worker.outstanding) < len(best.outstanding):
+                best = worker
+        return best
+
+
+STRATEGIES = dict(
+    lru=LeastRecentlyUsed,
+    hash=ConsistentHash,
+    least=LeastOutstanding
+)
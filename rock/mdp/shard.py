@@ -0,0 +1,243 @@
+"""
+Sharded Majordomo broker
+A front ROUTER owns the public endpoint and forwards every message to the
+shard broker that owns its service, picked by consistent hashing on the
+service name. Shards run in their own processes, so brokering is no longer
+capped at one core, and clients and workers see the plain MDP protocol.
+"""
+
+import os
+import signal
+import functools
+import tempfile
+import multiprocessing
+
+import zmq
+
+from . import MDP
+from .broker import MajorDomoBroker, terminate
+from .ring import HashRing
+from .zhelpers import dump, frame_bytes
+from .. import utils
+
+#  Sent once by a shard when it is connected and serving
+SHARD_READY = b"\001"
+
+
+class ShardBroker(MajorDomoBroker):
+    """A broker running behind a ShardRouter.
+    The router passes messages on exactly as its ROUTER socket received
+    them, so a DEALER sees the same [sender, '', header, ...] framing.
+    """
+    socket_type = zmq.DEALER
+
+    def connect(self, endpoint):
+        """Connect to the router and announce we are ready."""
+        self.socket.connect(endpoint)
+        self.socket.send(SHARD_READY)
+        self.log.info("I: MDP shard is active at %s", endpoint)
+
+    def delete_worker(self, worker, disconnect):
+        """Always tell the worker, so the router forgets it too."""
+        super(ShardBroker, self).delete_worker(worker, True)
+
+
+class Shard(multiprocessing.Process):
+    def __init__(self, name, endpoint, verbose=False, **kwargs):
+        super(Shard, self).__init__(daemon=True)
+        self._broker = name
+        self._endpoint = endpoint
+        self._verbose = verbose
+        self._kwargs = kwargs
+
+    def run(self):
+        # The router stops us with SIGTERM, save state before exiting
+        signal.signal(signal.SIGTERM, terminate)
+        broker = ShardBroker(self._broker, self._verbose, **self._kwargs)
+        try:
+            broker.connect(self._endpoint)
+            broker.mediate()
+        except KeyboardInterrupt:
+            pass  # Stopped outside of a poll
+        finally:
+            broker.destroy()
+
+
+class ShardRouter(object):
+    """Front end of a sharded Majordomo broker.
+    Client requests go to the shard owning the service, workers are pinned
+    to the shard they registered with until either side disconnects.
+    """
+
+    INTERNAL_SERVICE_PREFIX = MajorDomoBroker.INTERNAL_SERVICE_PREFIX
+    HEARTBEAT_INTERVAL = MajorDomoBroker.HEARTBEAT_INTERVAL
+
+    # ---------------------------------------------------------------------
+
+    ctx = None  # Our context
+    frontend = None  # Socket for clients & workers
+    backends = None  # One socket per shard
+    poller = None  # our Poller
+
+    ring = None  # Consistent hash ring of shard indexes
+    owners = None  # service name -> shard index
+    workers = None  # worker address -> shard index
+
+    budget = 1  # Max messages handled per socket per wakeup
+    zerocopy = False  # Forward body frames as zmq.Frame, uncopied
+    verbose = False  # Print activity to stdout
+
+    # ---------------------------------------------------------------------
+
+    def __init__(self, name, shards, verbose=False, budget=1,
+                 zerocopy=False, **kwargs):
+        """Start the shard processes and wait until they are serving.
+        Extra keyword arguments are handed to every ShardBroker.
+        """
+        self.verbose = verbose
+        self.budget = max(1, budget)
+        self.zerocopy = zerocopy
+        self.ring = HashRing(range(shards))
+        self.owners = {}
+        self.workers = {}
+        self.log = utils.logger(f'{name}.router')
+
+        prefix = os.path.join(
+            tempfile.gettempdir(), f'rock-{name}-{os.getpid()}'
+        )
+        endpoints = [f'ipc://{prefix}-{k}.ipc' for k in range(shards)]
+        # Each shard keeps its own journal and snapshot
+        journal = kwargs.pop('journal', None)
+        snapshot = kwargs.pop('snapshot', None)
+        self.shards = [
+            Shard(
+                name, endpoint, verbose, budget=budget, zerocopy=zerocopy,
+                journal=journal and os.path.join(journal, str(k)),
+                snapshot=snapshot and f'{snapshot}.{k}', **kwargs
+            )
+            for k, endpoint in enumerate(endpoints)
+        ]
+        for shard in self.shards:
+            shard.start()
+
+        self.ctx = zmq.Context()
+        self.frontend = self.ctx.socket(zmq.ROUTER)
+        self.frontend.linger = 0
+        self.frontend.router_handover = 1
+        self.poller = zmq.Poller()
+        self.poller.register(self.frontend, zmq.POLLIN)
+        self.backends = []
+        for endpoint in endpoints:
+            backend = self.ctx.socket(zmq.DEALER)
+            backend.linger = 0
+            backend.bind(endpoint)
+            self.poller.register(backend, zmq.POLLIN)
+            self.backends.append(backend)
+        for shard, backend in zip(self.shards, self.backends):
+            self.wait_ready(shard, backend)
+        self.log.info("I: %d broker shards are ready", shards)
+
+    def wait_ready(self, shard, backend):
+        """Wait for a shard to announce itself, as long as it runs."""
+        while not backend.poll(self.HEARTBEAT_INTERVAL):
+            if not shard.is_alive():
+                self.destroy()
+                raise RuntimeError(
+                    f'broker shard exited with code {shard.exitcode} '
+                    'while starting'
+                )
+        ready = backend.recv()
+        if ready != SHARD_READY:
+            self.destroy()
+            raise RuntimeError(f'broker shard sent {ready!r} while starting')
+
+    # ---------------------------------------------------------------------
+
+    def bind(self, endpoint):
+        """Bind router to endpoint, can call this multiple times."""
+        self.frontend.bind(endpoint)
+        self.log.info("I: MDP router/0.1.1 is active at %s", endpoint)
+
+    def mediate(self):
+        """Shuttle messages between the endpoint and the shards"""
+        while True:
+            try:
+                items = dict(self.poller.poll(self.HEARTBEAT_INTERVAL))
+            except KeyboardInterrupt:
+                break  # Interrupted
+            if self.frontend in items:
+                self.drain(self.frontend, self.route)
+            for shard, backend in enumerate(self.backends):
+                if backend in items:
+                    self.drain(backend, functools.partial(self.reply, shard))
+
+    def destroy(self):
+        """Stop shards once they have saved their state, destroy context."""
+        for shard in self.shards:
+            shard.terminate()
+        for shard in self.shards:
+            shard.join()
+        self.ctx.destroy(0)
+
+    def drain(self, socket, handler):
+        """Hand ready messages, up to budget, to handler."""
+        for _ in range(self.budget):
+            try:
+                msg = socket.recv_multipart(
+                    zmq.NOBLOCK, copy=not self.zerocopy
+                )
+            except zmq.Again:
+                break
+            if self.zerocopy:
+                msg[:4] = [frame.bytes for frame in msg[:4]]
+            if self.verbose:
+                self.log.info("I: received message:")
+                dump(msg)
+            handler(msg)
+
+    def owner(self, name):
+        """Shard index owning a service name."""
+        shard = self.owners.get(name)
+        if shard is None:
+            shard = self.owners[name] = self.ring.get(name)
+        return shard
+
+    def route(self, msg):
+        """Forward a client or worker message to its shard."""
+        if len(msg) < 4:
+            self.log.error("E: invalid message:")
+            dump(msg)
+            return
+
+        sender, empty, header, command = msg[:4]
+        if (MDP.C_CLIENT == header) or (MDP.C_CLIENT_X == header):
+            # mmi.service answers for the service it is asked about
+            if command.startswith(self.INTERNAL_SERVICE_PREFIX):
+                command = frame_bytes(msg[-1])
+            shard = self.owner(command)
+        elif (MDP.W_WORKER == header):
+            if (MDP.W_READY == command) and len(msg) > 4:
+                shard = self.owner(frame_bytes(msg[4]))
+                self.workers.setdefault(sender, shard)
+            elif (MDP.W_DISCONNECT == command):
+                shard = self.workers.pop(sender, 0)
+            else:
+                # Unknown workers are told to disconnect by any shard
+                shard = self.workers.get(sender, 0)
+        else:
+            self.log.error("E: invalid message:")
+            dump(msg)
+            return
+
+        self.backends[shard].send_multipart(msg)
+
+    def reply(self, shard, msg):
+        """Forward a shard message to its client or worker."""
+        if (MDP.W_WORKER == msg[2]):
+            if (MDP.W_DISCONNECT == msg[3]):
+                self.workers.pop(msg[0], None)
+            else:
+                # Shards restored from a snapshot probe workers we have
+                # not seen yet, their answers go back to that shard
+                self.workers.setdefault(msg[0], shard)
+        self.frontend.send_multipart(msg)
@@ -0,0 +1,52 @@
+"""Cheap latency histograms for broker and client statistics"""
+
+
+class Histogram(object):
+    """Latencies counted in power of two microsecond buckets.
+    Bucket k holds latencies under 2**k microseconds and at least half
+    that, so recording is a bit_length and an increment.
+    """
+    BUCKETS = 33  # the last one holds everything over ~36 minutes
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0  # seconds
+
+    def add(self, seconds):
+        k = max(0, int(1e6*seconds)).bit_length()
+        self.counts[min(k, self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def decay(self):
+        """Halve every count, so recent latencies weigh more."""
+        self.counts = [count >> 1 for count in self.counts]
+        self.count = sum(self.counts)
+        self.total /= 2
+
+    def percentile(self, q):
+        """Upper bound, in seconds, of the bucket holding percentile q."""
+        if not self.count:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for k, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return 1e-6 * (1 << k)
+        return 1e-6 * (1 << (self.BUCKETS - 1))
+
+    def dump(self):
+        """As a plain dict, trailing empty buckets trimmed."""
+        last = max(
+            (k for k, count in enumerate(self.counts) if count), default=-1
+        )
+        return dict(
+            count=self.count,
+            sum=self.total,
+            p50=self.percentile(50),
+            p95=self.percentile(95),
+            p99=self.percentile(99),
+            buckets=self.counts[:last + 1]
+        )
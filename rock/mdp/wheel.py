@@ -0,0 +1,89 @@
+"""Hierarchical timing wheel for the broker's per-worker timers"""
+
+import math
+
+
+class TimerWheel(object):
+    """Hierarchical timing wheel.
+    Timers land in a slot of the finest level that spans their delay and
+    are moved down a level as their time comes closer, so scheduling,
+    cancelling and each tick cost O(1) however many timers are pending.
+    Timers fire on the first tick at or after their time.
+    """
+    resolution = 0.05  # seconds per tick
+    slots = 64  # slots per level
+    levels = 3  # a level spans `slots` times the level below
+
+    def __init__(self, resolution=None, slots=None, levels=None, now=0.0):
+        if resolution is not None:
+            self.resolution = resolution
+        if slots is not None:
+            self.slots = slots
+        if levels is not None:
+            self.levels = levels
+        self.wheels = [
+            [{} for _ in range(self.slots)] for _ in range(self.levels)
+        ]
+        self.timers = {}  # key -> slot holding it
+        self.current = int(now // self.resolution)  # last tick run
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def schedule(self, key, when):
+        """Fire key at when, replacing any timer it already has."""
+        self.cancel(key)
+        tick = max(self.current + 1, math.ceil(when / self.resolution))
+        self.place(key, tick)
+
+    def cancel(self, key):
+        slot = self.timers.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def place(self, key, tick):
+        level, span = 0, self.slots
+        while tick - self.current >= span and level < self.levels - 1:
+            level, span = level + 1, span * self.slots
+        # Beyond the top level, park in its furthest slot until cascaded
+        at = min(tick, self.current + span - 1) // (span // self.slots)
+        slot = self.wheels[level][at % self.slots]
+        slot[key] = tick
+        self.timers[key] = slot
+
+    def next_at(self):
+        """Time of the next tick, or None with no timers pending."""
+        if self.timers:
+            return (self.current + 1) * self.resolution
+        return None
+
+    def advance(self, now):
+        """Run every tick up to now, returning the keys that fired."""
+        fired = []
+        target = int(now // self.resolution)
+        if not self.timers:
+            self.current = max(self.current, target)
+            return fired
+        while self.current < target:
+            self.current += 1
+            # Move timers down from coarser levels whose slot came up
+            for level in range(self.levels - 1, 0, -1):
+                span = self.slots ** level
+                if self.current % span == 0:
+                    slot = self.wheels[level][
+                        (self.current // span) % self.slots
+                    ]
+                    pending = list(slot.items())
+                    slot.clear()
+                    for key, tick in pending:
+                        self.place(key, tick)
+            slot = self.wheels[0][self.current % self.slots]
+            if slot:
+                for key in slot:
+                    del self.timers[key]
+                fired.extend(slot)
+                slot.clear()
+        return fired
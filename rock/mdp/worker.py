@@ -6,12 +6,34 @@ Based on Java example by Arkadiusz Orzechowski
 
 #import self.log
 import time
+import uuid
+import collections
 import zmq
 
-from .zhelpers import dump
+from .zhelpers import dump, context
 # MajorDomo protocol constants:
 from . import MDP
-from .. import utils
+from .. import utils, msg as codec
+
+
+def unwrap(envelope, prefetch=1):
+    """Properties from an extended client's return envelope.
+    The envelope is [tag, client, properties] with credit, and the
+    tag or properties frames are only there when used.
+    """
+    if len(envelope) <= (2 if prefetch > 1 else 1):
+        return {}
+    # Sent by clients, so anything but a map with a numeric deadline
+    # is ignored
+    try:
+        properties = codec.unpack(envelope[-1])
+    except Exception:
+        return {}
+    if not isinstance(properties, dict):
+        return {}
+    if not isinstance(properties.get('deadline', 0), (int, float)):
+        del properties['deadline']
+    return properties
 
 
 class MajorDomoWorker(object):
@@ -25,8 +47,7 @@ class MajorDomoWorker(object):
     service = None
 
     worker = None  # Socket to broker
-    # When to send HEARTBEAT (relative to time.time(), so in seconds)
-    heartbeat_at = 0
+    identity = None  # Routing id, kept across reconnects and broker restarts
     liveness = 0  # How many attempts left
     heartbeat = 2500  # Heartbeat delay, msecs
     reconnect = 2500  # Reconnect delay, msecs
@@ -34,19 +55,28 @@ class MajorDomoWorker(object):
     # Internal state
     expect_reply = False  # False only at start
 
-    timeout = 2500  # poller timeout
+    timeout = 2500  # poller timeout, one heartbeat
     verbose = False  # Print activity to stdout
 
     # Return address, if any
     reply_to = None
+    properties = None  # Properties of the current request, if any
+    expired = 0  # Requests skipped because their deadline passed
+
+    prefetch = 1  # Credit, how many requests the broker may send at once
+    requests = None  # Prefetched requests as (reply_to, msg)
 
-    def __init__(self, broker, service, verbose=False):
+    def __init__(self, broker, service, verbose=False, prefetch=1):
         self.broker = broker
         if type(service) == str:
             service = bytes(service, 'utf-8')
         self.service = service
         self.verbose = verbose
-        self.ctx = zmq.Context()
+        self.prefetch = max(1, prefetch)
+        self.identity = uuid.uuid4().hex.encode('utf-8')
+        self.requests = collections.deque()
+        self.properties = {}
+        self.ctx = context()
         self.poller = zmq.Poller()
         self.log = utils.logger(
             f"{service.decode('utf-8')}.service"
@@ -60,17 +90,20 @@ class MajorDomoWorker(object):
             self.worker.close()
         self.worker = self.ctx.socket(zmq.DEALER)
         self.worker.linger = 0
+        self.worker.identity = self.identity
         self.worker.connect(self.broker)
         self.poller.register(self.worker, zmq.POLLIN)
         if self.verbose:
             self.log.info("I: connecting to broker at %s...", self.broker)
 
-        # Register service with broker
-        self.send_to_broker(MDP.W_READY, self.service, [])
+        # Register service with broker, requests sent to the old socket
+        # can no longer be answered
+        self.requests.clear()
+        credit = [b'%d' % self.prefetch] if self.prefetch > 1 else []
+        self.send_to_broker(MDP.W_READY, self.service, credit)
 
         # If liveness hits zero, queue is considered disconnected
         self.liveness = self.HEARTBEAT_LIVENESS
-        self.heartbeat_at = time.time() + 1e-3 * self.heartbeat
 
     def send_to_broker(self, command, option=None, msg=None):
         """Send message to broker.
@@ -97,12 +130,25 @@ class MajorDomoWorker(object):
 
         if reply is not None:
             assert self.reply_to is not None
-            reply = [self.reply_to, b''] + reply
+            reply = self.reply_to + [b''] + reply
             self.send_to_broker(MDP.W_REPLY, msg=reply)
 
         self.expect_reply = True
 
         while True:
+            # Serve prefetched requests first, answering those whose
+            # client has already given up without handing them out
+            while self.requests:
+                self.reply_to, msg = self.requests.popleft()
+                self.properties = unwrap(self.reply_to, self.prefetch)
+                deadline = self.properties.get('deadline')
+                if deadline is not None and deadline < time.time():
+                    self.expired += 1
+                    reply = self.reply_to + [b'', MDP.R_TIMEOUT]
+                    self.send_to_broker(MDP.W_REPLY, msg=reply)
+                    continue
+                return msg  # We have a request to process
+
             # Poll socket for a reply, with timeout
             try:
                 items = self.poller.poll(self.timeout)
@@ -127,16 +173,15 @@ class MajorDomoWorker(object):
 
                 command = msg.pop(0)
                 if command == MDP.W_REQUEST:
-                    # We should pop and save as many addresses as there are
-                    # up to a null part, but for now, just save one...
-                    self.reply_to = msg.pop(0)
-                    # pop empty
-                    assert msg.pop(0) == b''
-
-                    return msg  # We have a request to process
+                    # Pop and save as many addresses as there are up to
+                    # a null part, extended clients add a properties frame
+                    empty = msg.index(b'')
+                    self.requests.append((msg[:empty], msg[empty + 1:]))
+                    continue
                 elif command == MDP.W_HEARTBEAT:
-                    # Do nothing for heartbeats
-                    pass
+                    # The broker spreads its heartbeats over the interval,
+                    # answering them keeps ours spread too
+                    self.send_to_broker(MDP.W_HEARTBEAT)
                 elif command == MDP.W_DISCONNECT:
                     self.reconnect_to_broker()
                 else:
@@ -154,15 +199,13 @@ class MajorDomoWorker(object):
                     except KeyboardInterrupt:
                         break
                     self.reconnect_to_broker()
-
-            # Send HEARTBEAT if it's time
-            if time.time() > self.heartbeat_at:
-                self.send_to_broker(MDP.W_HEARTBEAT)
-                self.heartbeat_at = time.time() + 1e-3*self.heartbeat
+                else:
+                    # A quiet heartbeat interval, so it's time to send one
+                    self.send_to_broker(MDP.W_HEARTBEAT)
 
         self.log.warn("W: interrupt received, killing worker...")
         return None
 
     def destroy(self):
-        # context.destroy depends on pyzmq >= 2.1.10
-        self.ctx.destroy(0)
+        # The context is shared by the whole process
+        self.worker.close()
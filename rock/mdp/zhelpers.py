@@ -9,6 +9,7 @@ import os
 from random import randint
 
 import zmq
+import zmq.asyncio
 
 
 #
@@ -20,7 +21,7 @@ def dump(msg_or_socket):
     else:
         msg = msg_or_socket
     print("----------------------------------------")
-    for part in msg:
+    for part in map(frame_bytes, msg):
         print("[%03d]" % len(part), end=' ')
         is_text = True
         try:
@@ -29,6 +30,23 @@ def dump(msg_or_socket):
             print(r"0x%s" % (binascii.hexlify(part).decode('ascii')))
 
 
+def frame_bytes(frame):
+    """Return frame contents as bytes, for frames received with copy=False"""
+    if isinstance(frame, zmq.Frame):
+        return frame.bytes
+    return frame
+
+
+def context():
+    """The process-wide context, a fresh one in a forked child"""
+    return zmq.Context.instance()
+
+
+def async_context():
+    """The process-wide context, for zmq.asyncio sockets"""
+    return zmq.asyncio.Context.shadow(context().underlying)
+
+
 def set_id(zsocket):
     """Set simple random printable identity on socket"""
     identity = u"%04x-%04x" % (randint(0, 0x10000), randint(0, 0x10000))
@@ -2,7 +2,20 @@ import msgpack
 
 
 def pack(data):
-    return msgpack.packb(data)
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def canonical(data):
+    """Packed with map keys sorted, so equal data packs to equal bytes."""
+    def sort(data):
+        if isinstance(data, dict):
+            return {
+                key: sort(data[key]) for key in sorted(data, key=repr)
+            }
+        if isinstance(data, (list, tuple)):
+            return [sort(item) for item in data]
+        return data
+    return msgpack.packb(sort(data), use_bin_type=True)
 
 
 def unpack(data):
@@ -1,4 +1,9 @@
+import time
+import asyncio
 import functools
+import threading
+import collections
+import concurrent.futures
 
 from . import msg
 from . import mdp
@@ -8,11 +13,126 @@ class RpcError(Exception):
     pass
 
 
+class ReplyCache(object):
+    """Replies to rpc calls, least recently used dropped first, each
+    kept for as long as the ttl of its method.
+    """
+    size = 1024  # Most replies kept
+    entries = None  # (service, method, args) -> (reply, expiry)
+    hits = 0
+    misses = 0
+    evictions = 0  # Replies dropped for room, not for being stale
+
+    def __init__(self, size=None):
+        if size is not None:
+            self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, reply, ttl):
+        with self.lock:
+            self.entries[key] = (reply, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return dict(
+            hits=self.hits, misses=self.misses,
+            evictions=self.evictions, size=len(self.entries)
+        )
+
+
+class SingleFlight(object):
+    """Identical calls in flight at once share one request, and each
+    gets its own copy of the reply.
+    """
+    methods = None  # Methods whose calls are coalesced, all if None
+    calls = None  # (service, method, args) -> Future of the reply
+    tasks = None  # The same, for calls awaited on an event loop
+    collapsed = 0  # Calls answered by another call's request
+
+    def __init__(self, methods=None):
+        if methods is not None:
+            self.methods = frozenset(methods)
+        self.calls = {}
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def coalesces(self, method):
+        return self.methods is None or method in self.methods
+
+    def run(self, key, send):
+        """The reply of send(), or of the identical call in flight."""
+        with self.lock:
+            reply = self.calls.get(key)
+            if reply is not None:
+                self.collapsed += 1
+            else:
+                self.calls[key] = concurrent.futures.Future()
+        if reply is not None:
+            return reply.result()
+        try:
+            result = send()
+        except BaseException as err:
+            # Even an interrupted call must let the others go
+            self.calls[key].set_exception(err)
+            raise
+        else:
+            self.calls[key].set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    async def arun(self, key, send):
+        """run() for coroutines, `await send()` gives the reply."""
+        reply = self.tasks.get(key)
+        if reply is not None:
+            self.collapsed += 1
+            return await asyncio.shield(reply)
+        reply = self.tasks[key] = asyncio.ensure_future(send())
+        try:
+            return await asyncio.shield(reply)
+        finally:
+            del self.tasks[key]
+
+    def stats(self):
+        return dict(
+            collapsed=self.collapsed,
+            inflight=len(self.calls) + len(self.tasks)
+        )
+
+
 class MethodProxy:
-    def __init__(self, method, service, client):
+    def __init__(self, method, service, client, priority=None, key=None,
+                 cache=None, ttl=None, flight=None):
         self._service = service
         self._method = method
         self._client = client
+        self._priority = priority
+        self._key = key
+        # Replies are cached for ttl secs when the service allows it
+        self._cache = cache
+        self._ttl = ttl
+        # Identical calls in flight share one request when set
+        self._flight = flight
+        if flight is not None and not flight.coalesces(method):
+            self._flight = None
 
     def _send_reply(self, reply):
         if not reply:
@@ -21,41 +141,288 @@ class MethodProxy:
                 detail='service server may not be running'
             )
             return error
+        if reply[-1] == mdp.MDP.R_BUSY:
+            error = dict(
+                ok=False, error='ServiceBusy',
+                detail='service queue is full, try again later'
+            )
+            return error
+        if reply[-1] == mdp.MDP.R_NOT_FOUND:
+            error = dict(
+                ok=False, error='ServiceUnavailable',
+                detail='service has no workers, failing fast until it does'
+            )
+            return error
+        if reply[-1] == mdp.MDP.R_TIMEOUT:
+            error = dict(
+                ok=False, error='DeadlineExceeded',
+                detail='request expired before it was served'
+            )
+            return error
         return msg.unpack(reply[-1])
 
     def _prepare(self, args):
         return msg.pack(dict(method=self._method, args=args))
 
+    def _routing_key(self, args):
+        if self._key is None:
+            return None
+        return self._key(self._method, args)
+
     def _send_request(self, **kwargs):
         request = self._prepare(kwargs)
-        return self._client.send(self._service, request)
+        return self._client.send(
+            self._service, request, self._priority, self._routing_key(kwargs)
+        )
+
+    def _call_key(self, args):
+        return (self._service, self._method, msg.canonical(args))
+
+    def _fetch(self, args):
+        if self._flight is None:
+            return self._send_request(**args)
+        return self._flight.run(
+            self._call_key(args), functools.partial(self._send_request, **args)
+        )
 
     def __call__(self, **kwargs):
-        reply = self._send_request(**kwargs)
-        return self._send_reply(reply)
+        if self._cache is None or not self._ttl:
+            reply = self._fetch(kwargs)
+            return self._send_reply(reply)
+        key = self._call_key(kwargs)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return msg.unpack(cached)
+        reply = self._fetch(kwargs)
+        data = self._send_reply(reply)
+        if data.get('ok') is not False:
+            self._cache.put(key, reply[-1], self._ttl)
+        return data
+
+    def _prepare_batch(self, calls):
+        return [mdp.MDP.B_BATCH] + [
+            msg.pack(dict(method=method, args=args))
+            for method, args, result in calls
+        ]
+
+    def _settle_batch(self, calls, reply):
+        """Hand each call its result, or all of them the error."""
+        if reply and reply[0] == mdp.MDP.B_BATCH:
+            for (method, args, result), data in zip(calls, reply[1:]):
+                result.set_result(msg.unpack(data))
+            return
+        error = self._send_reply(reply)
+        if error.get('ok') is not False:
+            error = dict(
+                ok=False, error='BatchNotSupported',
+                detail='service server does not take batched calls'
+            )
+        for method, args, result in calls:
+            result.set_result(error)
+
+    def _send_batch(self, calls):
+        # Routed by the key of the first call, the proxy's method
+        method, args, result = calls[0]
+        reply = self._client.send(
+            self._service, self._prepare_batch(calls),
+            self._priority, self._routing_key(args)
+        )
+        self._settle_batch(calls, reply)
 
 
 class AsyncMethodProxy(MethodProxy):
-    def _send_request(self, **kwargs):
+    """Calls return a future of the reply, so many can be in flight."""
+
+    def __call__(self, **kwargs):
+        request = self._prepare(kwargs)
+        return self._client.call(
+            self._service, request, self._priority,
+            self._routing_key(kwargs), convert=self._send_reply
+        )
+
+    def _send_batch(self, calls):
+        # Routed by the key of the first call, the proxy's method
+        method, args, result = calls[0]
+        return self._client.call(
+            self._service, self._prepare_batch(calls), self._priority,
+            self._routing_key(args),
+            callback=lambda reply: self._settle_batch(calls, reply.result())
+        )
+
+
+class AioMethodProxy(MethodProxy):
+    """Calls are awaited on the event loop, `await proxy.method(**kw)`."""
+
+    async def _send_request(self, **kwargs):
         request = self._prepare(kwargs)
-        self._client.send(self._service, request)
-        return self._client.recv()
+        return await self._client.send(
+            self._service, request, self._priority, self._routing_key(kwargs)
+        )
+
+    async def __call__(self, **kwargs):
+        if self._flight is None:
+            reply = await self._send_request(**kwargs)
+        else:
+            reply = await self._flight.arun(
+                self._call_key(kwargs),
+                functools.partial(self._send_request, **kwargs)
+            )
+        return self._send_reply(reply)
+
+    async def _send_batch(self, calls):
+        # Routed by the key of the first call, the proxy's method
+        method, args, result = calls[0]
+        reply = await self._client.send(
+            self._service, self._prepare_batch(calls),
+            self._priority, self._routing_key(args)
+        )
+        self._settle_batch(calls, reply)
+
+
+class BatchResult(concurrent.futures.Future):
+    """Future result of one call in a batch."""
+    batch = None  # Future reply to the whole batch, if sent with one
+
+    def result(self, timeout=None):
+        # Waiting on an AsyncRpcProxy reply is what reads it
+        if self.batch is not None and not self.done():
+            self.batch.result(timeout)
+        return super(BatchResult, self).result(timeout)
+
+
+class Batch(object):
+    """Calls collected on a proxy and sent as one request on leaving
+    the block, `with proxy.batch() as batch`, or `async with` for an
+    AioRpcProxy. Each call returns a future of its result.
+    """
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._calls = []
+
+    def __getattr__(self, attr):
+        return functools.partial(self._add, attr)
+
+    def _add(self, method, **kwargs):
+        result = BatchResult()
+        self._calls.append((method, kwargs, result))
+        return result
+
+    def _send(self):
+        calls, self._calls = self._calls, []
+        if not calls:
+            return
+        reply = getattr(self._proxy, calls[0][0])._send_batch(calls)
+        if isinstance(reply, concurrent.futures.Future):
+            for method, args, result in calls:
+                result.batch = reply
+        return reply
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self._send()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        if type is None and self._calls:
+            await self._send()
 
 
 class BaseProxy(object):
-    def __init__(self, client, method, broker, service, verbose=False):
-        self._client = client(broker, service, verbose)
+    INFO_RETRY = 5.0  # Secs before asking again for ttls info failed to give
+
+    def __init__(self, client, method, broker, service, verbose=False,
+                 priority=None, key=None, cache=None, flight=None):
+        # Proxies to the same broker share their client sockets, a
+        # pipelined one per thread, so the socket is picked per call
+        self._clients = mdp.pool.pool(client, broker, verbose)
+        self._broker = broker
+        self._verbose = verbose
         self._service = service
         if type(service) == str:
             self._service = bytes(service, 'utf-8')
         self._method_cls = method
+        self._priority = priority
+        # key(method, args) gives the routing key of a call, if any
+        self._key = key
+        # A ReplyCache for the methods the service says are cacheable,
+        # used by RpcProxy calls
+        self._cache = cache
+        self._ttls = None
+        self._ttls_at = 0  # When ttls may be asked for again
+        # A SingleFlight coalescing identical calls in flight, not used
+        # by AsyncRpcProxy calls
+        self._flight = flight
+
+    def batch(self):
+        return Batch(self)
+
+    def _ttl(self, method):
+        """How long replies to method may be cached, from service info.
+        Only blocking calls use the cache, so other proxies never ask.
+        """
+        if self._cache is None or self._method_cls is not MethodProxy:
+            return None
+        if method == 'info':
+            return None
+        if self._ttls is None:
+            if time.time() < self._ttls_at:
+                return None
+            info = MethodProxy('info', self._service, self._clients.get())()
+            if info.get('ok') is False:
+                # Calls go uncached meanwhile, not each waiting on info
+                self._ttls_at = time.time() + self.INFO_RETRY
+                return None
+            self._ttls = {
+                rpc['method']: rpc['ttl']
+                for rpc in info.get('rpc', []) if rpc.get('ttl')
+            }
+        return self._ttls.get(method)
 
     def __getattr__(self, attr):
         return self._method_cls(
-            attr, self._service, self._client
+            attr, self._service, self._clients.get(), self._priority,
+            self._key, self._cache, self._ttl(attr), self._flight
         )
 
 
+def scatter(broker, targets, timeout=None, priority=None, verbose=False):
+    """Call several services, or several shards of one, at once and
+    wait for the replies until a shared deadline, timeout secs away.
+    targets maps a name to (service, method, args), or (service, method,
+    args, key) with the routing key of a sharded service.
+    Returns the results of the calls that went well and the errors of
+    the others, each by name.
+    """
+    client = mdp.pool.client(mdp.aclient.MajorDomoClient, broker, verbose)
+    if timeout is None:
+        timeout = 1e-3*client.timeout
+    replies = {}
+    for name, target in targets.items():
+        service, method, args, key = (tuple(target) + (None,))[:4]
+        if type(service) == str:
+            service = bytes(service, 'utf-8')
+        proxy = MethodProxy(method, service, client, priority)
+        replies[name] = client.call(
+            service, proxy._prepare(args), priority, key,
+            convert=proxy._send_reply, timeout=1e3*timeout
+        )
+    # Every call has the same deadline, so the order we wait in is moot
+    results, errors = {}, {}
+    for name, reply in replies.items():
+        data = reply.result()
+        if data.get('ok') is False:
+            errors[name] = data
+        else:
+            results[name] = data
+    return results, errors
+
+
 def rpc_proxy_factory(client, method):
     return functools.partial(BaseProxy, client, method)
 
@@ -68,3 +435,7 @@ AsyncRpcProxy = rpc_proxy_factory(
     mdp.aclient.MajorDomoClient,
     AsyncMethodProxy
 )
+AioRpcProxy = rpc_proxy_factory(
+    mdp.aioclient.MajorDomoClient,
+    AioMethodProxy
+)
@@ -1,10 +1,14 @@
+import os
 import sys
+import time
+import asyncio
 import platform
 import signal
 import functools
 import inspect
 import collections
 import multiprocessing
+import concurrent.futures
 import subprocess
 
 from . import utils, mdp, sas, msg, repo
@@ -35,6 +39,20 @@ class TaskError(Exception):
     pass
 
 
+EXECUTORS = ('thread', 'process')
+
+_pooled = None  # The service whose rpc methods run on a process pool
+_inherited = None  # Its parent's repository, in a pool process, never used
+
+
+def _setup_pooled():
+    _pooled._setup_pooled()
+
+
+def _serve_pooled(message):
+    return _pooled._serve(message)
+
+
 class Consumer(multiprocessing.Process):
     def __init__(self, tasks, queue, log):
         super(Consumer, self).__init__()
@@ -95,13 +113,21 @@ class BaseService(object):
     __slots__ = (
         '_worker', '_repo', '_cache',
         '_log', '_events', '_sas',
-        '_queue', '_consumers'
+        '_queue', '_consumers', '_expired', '_pool',
+        '_conf', '_secret'
     )
 
     _name = None
     _version = None
+    _concurrency = 16  # Requests an async or pooled service takes at once
+    _executor = None  # 'thread' or 'process' to run rpc methods on a pool
+    _prefork = 0  # Worker processes forked after setup, 0 to serve in this one
+    _respawn = 1.0  # Secs between checks that forked workers are alive
+    _startsecs = 10.0  # Secs a forked worker must run for not to have crashed
+    _backoff = 60.0  # Longest wait before respawning crashing workers
     _rpc = dict()
     _info = dict()
+    _ttl = dict()  # Secs clients may cache replies of rpc methods for
 
     def __new__(cls, *args, **kwargs):
         inst = super(BaseService, cls).__new__(cls)
@@ -119,11 +145,18 @@ class BaseService(object):
                 if rpc != 'info':
                     name = f.__name__
                     args = inspect.getargspec(f)[0][1:]
-                    inst._info['rpc'].append(dict(method=name, args=args))
+                    entry = dict(method=name, args=args)
+                    if rpc in cls._ttl:
+                        entry['ttl'] = cls._ttl[rpc]
+                    inst._info['rpc'].append(entry)
         return inst
 
     def __init__(self, conf):
         self._log = utils.logger(f'{self._name}.service')
+        self._expired = 0
+        self._pool = None
+        self._worker = None
+        self._secret = None
         self._setup(conf)
 
     def __enter__(self):
@@ -133,10 +166,20 @@ class BaseService(object):
         self._close()
 
     def __call__(self):
+        if self._worker is None:
+            return self._supervise()
+
         if hasattr(self, '_consumers'):
             self._start_consumers()
         self._log.info('service is ready...')
 
+        if self._is_concurrent():
+            try:
+                asyncio.run(self._worker.run(self._handle))
+            except KeyboardInterrupt:
+                self._close()
+            return
+
         reply = None
         while True:
             try:
@@ -146,27 +189,117 @@ class BaseService(object):
             except KeyboardInterrupt:
                 self._close()
             else:
-                request = self._parse(message[-1])
-                reply = self._reply(request)
+                if self._expired_request():
+                    reply = [mdp.MDP.R_TIMEOUT]
+                else:
+                    reply = self._serve(message)
+
+    def _is_async(self):
+        return any(
+            inspect.iscoroutinefunction(f) for f in self._rpc.values()
+        )
+
+    def _is_concurrent(self):
+        return self._is_async() or self._pool is not None
+
+    def _serve(self, message):
+        if message[0] == mdp.MDP.B_BATCH:
+            return self._reply_batch(message[1:])
+        request = self._parse(message[-1])
+        return self._reply(request)
+
+    async def _handle(self, message, properties):
+        # The async worker answers expired requests itself
+        if self._pool is not None:
+            # The event loop keeps heartbeats going meanwhile
+            serve = self._serve
+            if isinstance(self._pool, concurrent.futures.ProcessPoolExecutor):
+                serve = _serve_pooled
+            return await asyncio.get_event_loop().run_in_executor(
+                self._pool, serve, message
+            )
+        if message[0] == mdp.MDP.B_BATCH:
+            return await self._areply_batch(message[1:])
+        request = self._parse(message[-1])
+        return await self._areply(request)
+
+    def _expired_request(self):
+        deadline = self._worker.properties.get('deadline')
+        if deadline is not None and deadline < time.time():
+            self._expired += 1
+            return True
+        return False
 
     def _setup(self, conf):
+        self._conf = conf
         self._setup_cloud(conf['credentials'], conf['stage'])
-        self._setup_worker(conf['broker'], conf['verbose'])
+        if conf.get('prefork', self._prefork):
+            # Children share what is loaded here, and set up the rest
+            self._service_secret(conf['bucket'])
+            self._log.info('service initialized, forking workers...')
+            return
+        self._setup_process(conf)
+
+    def _setup_process(self, conf):
+        concurrency = conf.get('concurrency', self._concurrency)
+        self._setup_pool(conf.get('executor', self._executor), concurrency)
+        prefetch = concurrency if self._is_concurrent() else 1
+        self._setup_worker(
+            conf['broker'], conf['verbose'], conf.get('prefetch', prefetch)
+        )
         self._setup_clients(conf['broker'], conf['verbose'])
         self._setup_service(conf['bucket'])
         self._log.info('service initialized...')
         signal.signal(signal.SIGTERM, self._close)
 
-    def _setup_worker(self, broker, verbose=False):
-        self._worker = mdp.worker.MajorDomoWorker(
-            broker, self._name, verbose
-        )
+    def _setup_pool(self, executor, size):
+        # Rpc methods of a sync service can run on a pool of threads, or
+        # of forked processes, while the worker's event loop goes on
+        if executor is None or self._is_async():
+            return
+        if executor not in EXECUTORS:
+            raise ValueError(f'executor must be one of {", ".join(EXECUTORS)}')
+        if executor == 'thread':
+            self._pool = concurrent.futures.ThreadPoolExecutor(size)
+        else:
+            global _pooled
+            _pooled = self
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                size, mp_context=multiprocessing.get_context('fork'),
+                initializer=_setup_pooled
+            )
+
+    def _setup_pooled(self):
+        # A pool process is forked whenever the pool needs one, after
+        # the repository and clients are set up, so it opens its own
+        # rather than share the parent's connections
+        global _inherited
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # Closing it here would close it for the parent too
+        _inherited = getattr(self, '_repo', None)
+        self._pool = None
+        self._worker = None
+        self._setup_clients(self._conf['broker'], self._conf['verbose'])
+        self._setup_service(self._conf['bucket'])
+
+    def _setup_worker(self, broker, verbose=False, prefetch=1):
+        # Async and pooled services serve requests concurrently from an
+        # event loop, the others serve one request at a time
+        worker = mdp.worker.MajorDomoWorker
+        if self._is_concurrent():
+            worker = mdp.aioworker.MajorDomoWorker
+        self._worker = worker(broker, self._name, verbose, prefetch)
 
     def _setup_cloud(self, credentials, stage):
         self._sas = sas.AWSProvider(credentials, stage)
 
+    def _service_secret(self, bucket):
+        if self._secret is None:
+            self._secret = self._sas.get_service_secret(self._name, bucket)
+        return self._secret
+
     def _setup_service(self, bucket):
-        conf = self._sas.get_service_secret(self._name, bucket)
+        conf = self._service_secret(bucket)
         if not conf:
             return
 
@@ -207,10 +340,35 @@ class BaseService(object):
             data['ok'] = True
         return [msg.pack(data)]
 
+    async def _areply(self, request):
+        try:
+            data = await utils.alog_metrics(self, request)
+        except Exception as err:
+            data = utils.error(err)
+        else:
+            data['ok'] = True
+        return [msg.pack(data)]
+
+    def _reply_batch(self, calls):
+        # One frame per call, each result with its own ok or error
+        return [mdp.MDP.B_BATCH] + [
+            self._reply(self._parse(call))[0] for call in calls
+        ]
+
+    async def _areply_batch(self, calls):
+        replies = await asyncio.gather(
+            *[self._areply(self._parse(call)) for call in calls]
+        )
+        return [mdp.MDP.B_BATCH] + [reply[0] for reply in replies]
+
     def _parse(self, message):
         return RequestParser(**msg.unpack(message))
 
     def _cleanup(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._log.info('rpc pool shut down...')
+
         if hasattr(self, '_repo'):
             self._repo.close()
             self._log.info('persistent layer connetion closed...')
@@ -225,5 +383,72 @@ class BaseService(object):
     def _close(self, *args, **kwargs):
         self._cleanup()
 
+    def _fork(self):
+        """Start a worker process, returns its pid."""
+        pid = os.fork()
+        if pid:
+            self._log.info(f'worker {pid} forked...')
+            return pid
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        def stop(*args):
+            self._close()
+            os._exit(0)
+
+        code = 0
+        try:
+            # Sockets, connections and pools are the child's own
+            self._setup_process(self._conf)
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+            self()
+        except BaseException as err:
+            self._log.exception(err)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _supervise(self):
+        """Fork the workers and respawn any that exit, until stopped.
+        Workers that keep crashing as they start are respawned after a
+        wait that doubles each time, up to _backoff secs.
+        """
+        count = self._conf.get('prefork', self._prefork)
+        children = {}  # pid -> when it was forked
+        stopping = []
+        delay = 0  # Wait before respawning, while workers keep crashing
+        fork_at = 0  # When workers may be forked again
+
+        def stop(*args):
+            stopping.append(True)
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        while not stopping or children:
+            while not stopping and len(children) < count \
+                    and time.time() >= fork_at:
+                children[self._fork()] = time.time()
+            time.sleep(self._respawn)
+            for pid in list(children):
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if not done:
+                    continue
+                forked = children.pop(pid)
+                if stopping:
+                    continue
+                now = time.time()
+                if now - forked < self._startsecs:
+                    delay = min(2*delay or self._respawn, self._backoff)
+                else:
+                    delay = 0
+                fork_at = now + delay
+                self._log.warning(
+                    f'worker {pid} exited with status {status}, '
+                    f'respawning in {delay:.0f}s...'
+                )
+        self._close()
+
     def info(self):
         return self._info
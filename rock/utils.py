@@ -3,6 +3,7 @@ import logging
 import collections
 import yaml
 import time
+import inspect
 import secrets
 import bcrypt
 
@@ -67,15 +68,32 @@ def parse_config(section=None):
     return conf
 
 
-def log_metrics(cls, req):
-    start = time.time()
+def rpc_endpoint(cls, method):
     try:
-        f = cls._rpc[req.method]
+        return cls._rpc[method]
     except KeyError:
-        raise rpc.RpcError(f'`{req.method}` rpc endpoint does not exist')
-    results = f(cls, **req.args)
+        raise rpc.RpcError(f'`{method}` rpc endpoint does not exist')
+
+
+def log_elapsed(cls, method, start):
     elapsed = 1000.*(time.time() - start)
-    cls._log.info(f'{req.method} {elapsed:0.2f}ms')
+    cls._log.info(f'{method} {elapsed:0.2f}ms')
+
+
+def log_metrics(cls, req):
+    start = time.time()
+    results = rpc_endpoint(cls, req.method)(cls, **req.args)
+    log_elapsed(cls, req.method, start)
+    return results
+
+
+async def alog_metrics(cls, req):
+    """log_metrics for async services, rpc methods may be coroutines."""
+    start = time.time()
+    results = rpc_endpoint(cls, req.method)(cls, **req.args)
+    if inspect.isawaitable(results):
+        results = await results
+    log_elapsed(cls, req.method, start)
     return results
 
 
@@ -0,0 +1,81 @@
+"""
+Dispatch cost of the broker as its queues and worker pools grow
+The broker's socket is swapped for one that drops what is sent, so only
+the broker's own bookkeeping is timed. Each iteration takes one client
+request in and one worker reply out, and the microseconds per request
+should stay flat however deep the backlog or large the idle pool.
+
+    python test/bench_dispatch.py [-n ITERATIONS]
+"""
+
+import time
+from argparse import ArgumentParser
+
+from rock.mdp import MDP
+from rock.mdp.broker import MajorDomoBroker, Request
+
+
+class NullSocket(object):
+    """Stands in for the broker's ROUTER, sends go nowhere"""
+
+    def send_multipart(self, msg, *args, **kwargs):
+        pass
+
+
+def broker():
+    broker = MajorDomoBroker('bench')
+    broker.socket.close()
+    broker.socket = NullSocket()
+    return broker
+
+
+def backlog(depth, n):
+    """One busy worker behind a deep queue, each reply takes the head."""
+    b = broker()
+    service = b.require_service(b'echo')
+    for k in range(depth + 1):
+        b.dispatch(service, Request([b'c', b'', b'x']))
+    b.process_worker(b'w', [MDP.W_READY, b'echo'])
+    start = time.perf_counter()
+    for k in range(n):
+        b.process_client(b'c', [b'echo', b'x'])
+        b.process_worker(b'w', [MDP.W_REPLY, b'c', b'', b'y'])
+    elapsed = time.perf_counter() - start
+    b.destroy()
+    return 1e6*elapsed/n
+
+
+def pool(workers, n):
+    """A large idle pool, spread over two services."""
+    b = broker()
+    addresses = [b'w%05d' % k for k in range(workers)]
+    for k, address in enumerate(addresses):
+        service = b'echo' if k % 2 else b'other'
+        b.process_worker(address, [MDP.W_READY, service])
+    start = time.perf_counter()
+    for k in range(n):
+        b.process_client(b'c', [b'echo', b'x'])
+        address = addresses[2*(k % (workers // 2)) + 1]
+        b.process_worker(address, [MDP.W_REPLY, b'c', b'', b'y'])
+    elapsed = time.perf_counter() - start
+    b.destroy()
+    return 1e6*elapsed/n
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-n', '--iterations', dest='n', type=int,
+        help='requests timed per case', default=20000
+    )
+    options = parser.parse_args()
+    for depth in (100, 10000, 100000):
+        cost = backlog(depth, options.n)
+        print(f'queue depth  {depth:7d}  {cost:6.2f} us/req')
+    for workers in (10, 1000, 10000):
+        cost = pool(workers, options.n)
+        print(f'idle workers {workers:7d}  {cost:6.2f} us/req')
+
+
+if __name__ == "__main__":
+    main()
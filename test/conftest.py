@@ -0,0 +1,42 @@
+import socket
+import threading
+
+import pytest
+
+from rock.mdp import broker as mdbroker, worker as mdworker
+
+
+def free_endpoint():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return 'tcp://127.0.0.1:%d' % s.getsockname()[1]
+
+
+def start_broker(**kwargs):
+    """Endpoint of a broker mediating in a background thread."""
+    endpoint = free_endpoint()
+    broker = mdbroker.MajorDomoBroker('test', **kwargs)
+    broker.bind(endpoint)
+    threading.Thread(target=broker.mediate, daemon=True).start()
+    return endpoint
+
+
+@pytest.fixture
+def endpoint():
+    return start_broker()
+
+
+def start_worker(endpoint, service, handler, **kwargs):
+    """Serve service with handler(msg) -> reply in a background thread."""
+    worker = mdworker.MajorDomoWorker(endpoint, service, **kwargs)
+
+    def serve():
+        reply = None
+        while True:
+            msg = worker.recv(reply)
+            if msg is None:
+                break
+            reply = handler(msg)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return worker
@@ -0,0 +1,160 @@
+import time
+import threading
+from binascii import hexlify
+
+import pytest
+import zmq
+
+from rock import msg as codec
+from rock.mdp import MDP, zhelpers
+from rock.mdp.broker import MajorDomoBroker, Request, RequestQueue
+from rock.mdp.ring import HashRing
+from rock.mdp.routing import STRATEGIES, Strategy
+from rock.mdp.shard import SHARD_READY, Shard, ShardRouter
+
+from conftest import free_endpoint, start_broker, start_worker
+
+
+@pytest.mark.parametrize('key', [42, 4.2, [1, 'a'], {'b': 1, 'a': 2}, None])
+def test_ring_hashes_any_key(key):
+    ring = HashRing(['w0', 'w1'])
+    assert ring.get(key) in ('w0', 'w1')
+    assert ring.get(key) == ring.get(key)
+
+
+def test_trim_only_drops_expired_requests_at_the_head():
+    queue = RequestQueue((1, 1))
+    for deadline, priority in ((1, 0), (3, 0), (1, 0), (2, 1)):
+        props = dict(deadline=deadline, priority=priority)
+        queue.append(Request([b'c', props, b'', b'x'], props))
+    assert [r.deadline for r in queue.trim(2.5)] == [1, 2]
+    assert [r.deadline for r in queue] == [3, 1]
+    assert [r.deadline for r in queue.expire(2.5)] == [1]
+    assert len(queue) == 1
+
+
+def request(socket, service, props, body=b'x'):
+    socket.send_multipart([b'', MDP.C_CLIENT_X, service, props, body])
+    if socket.poll(2000):
+        return socket.recv_multipart()[4:]
+
+
+def test_bad_properties_do_not_kill_the_broker():
+    endpoint = start_broker(routing='hash')
+    start_worker(endpoint, b'echo', lambda msg: msg)
+    socket = zhelpers.context().socket(zmq.DEALER)
+    socket.linger = 0
+    socket.connect(endpoint)
+    for props in (
+        codec.pack(dict(key=42, deadline='soon', priority='high')),
+        codec.pack([1, 2]),
+        b'\xc1',  # not msgpack
+    ):
+        assert request(socket, b'echo', props) == [b'x']
+    socket.close()
+
+
+def test_quiet_worker_with_requests_in_flight_is_purged():
+    broker = MajorDomoBroker('test')
+    broker.process_worker(b'w1', [MDP.W_READY, b'echo', b'4'])
+    broker.process_client(b'c1', [b'echo', b'x'])
+    worker = broker.workers[hexlify(b'w1')]
+    assert len(worker.outstanding) == 1
+    assert worker.identity not in broker.waiting
+
+    # Not heard from since, so its request goes to the next worker
+    broker.send_heartbeats(worker.expiry + 1e-3*broker.HEARTBEAT_INTERVAL)
+    assert worker.identity not in broker.workers
+    service = broker.services[b'echo']
+    assert len(service.requests) == 1
+    broker.process_worker(b'w2', [MDP.W_READY, b'echo'])
+    assert not service.requests and service.dispatched == 2
+    broker.destroy()
+
+
+def test_peer_replies_give_back_capacity():
+    # A peer that rarely advertises, so mostly replies free its workers
+    far, state, near = free_endpoint(), free_endpoint(), free_endpoint()
+    peer = MajorDomoBroker('far')
+    peer.ADVERTISE_INTERVAL = 1000
+    peer.bind(far)
+    peer.federate(state)
+    broker = MajorDomoBroker('near')
+    broker.bind(near)
+    broker.peer(far, state)
+    threading.Thread(target=peer.mediate, daemon=True).start()
+    threading.Thread(target=broker.mediate, daemon=True).start()
+    start_worker(far, b'echo', lambda msg: msg)
+    expires = time.time() + 5
+    while not broker.peers[0].capacity.get(b'echo'):
+        assert time.time() < expires
+        time.sleep(0.05)
+
+    socket = zhelpers.context().socket(zmq.DEALER)
+    socket.linger = 0
+    socket.connect(near)
+    start = time.time()
+    for k in range(5):
+        assert request(socket, b'echo', codec.pack({})) == [b'x']
+    assert time.time() - start < 0.5
+    socket.close()
+
+
+def test_terminated_shard_saves_its_snapshot(tmp_path):
+    snapshot = str(tmp_path / 'registry')
+    endpoint = f'ipc://{tmp_path}/shard.ipc'
+    router = zhelpers.context().socket(zmq.DEALER)
+    router.linger = 0
+    router.bind(endpoint)
+    shard = Shard('test', endpoint, snapshot=snapshot)
+    shard.start()
+    assert router.poll(5000) and router.recv() == SHARD_READY
+    shard.terminate()
+    shard.join(5)
+    assert shard.exitcode == 0
+    assert codec.unpack(open(snapshot, 'rb').read())['workers'] == []
+    router.close()
+
+
+class Recorder(object):
+    """Stands in for the broker's ROUTER, keeps what is sent"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_multipart(self, msg, *args, **kwargs):
+        self.sent.append(msg)
+
+
+def test_snapshot_restart_keeps_workers_and_their_requests(tmp_path):
+    kwargs = dict(journal=str(tmp_path), snapshot=str(tmp_path / 'registry'))
+    broker = MajorDomoBroker('test', **kwargs)
+    broker.socket.close()
+    broker.socket = Recorder()
+    broker.process_worker(b'w1', [MDP.W_READY, b'echo', b'4'])
+    broker.process_client(b'c1', [b'echo', b'x'])
+    broker.destroy()
+    commands = [msg[3] for msg in broker.socket.sent]
+    assert commands == [MDP.W_REQUEST]  # No disconnect
+
+    # The request is still the worker's, so it is not run again
+    broker = MajorDomoBroker('test', **kwargs)
+    assert not broker.services[b'echo'].requests
+    assert broker.workers[hexlify(b'w1')].probing
+    broker.destroy()
+
+
+def test_router_fails_when_a_shard_dies_starting(tmp_path):
+    journal = tmp_path / 'journal'
+    journal.write_bytes(b'')  # Not a directory, so shards cannot start
+    with pytest.raises(RuntimeError):
+        ShardRouter('test', 2, journal=str(journal))
+
+
+def test_strategies_must_select():
+    class Idle(Strategy):
+        pass
+
+    with pytest.raises(TypeError):
+        Idle()
+    assert all(isinstance(cls(), Strategy) for cls in STRATEGIES.values())
@@ -0,0 +1,55 @@
+import time
+
+from rock.mdp import MDP, client as mdclient
+from rock.mdp.circuit import Circuit, CLOSED, OPEN, HALF_OPEN
+
+
+def test_opens_after_threshold_failures_in_a_row():
+    circuit = Circuit()
+    for k in range(Circuit.THRESHOLD - 1):
+        circuit.failure(0)
+    assert circuit.state == CLOSED
+    circuit.success()
+    for k in range(Circuit.THRESHOLD - 1):
+        circuit.failure(0)
+    assert circuit.state == CLOSED  # The success reset the count
+    circuit.failure(0)
+    assert circuit.state == OPEN and circuit.opened == 1
+
+
+def test_trips_at_once_when_the_service_has_no_workers():
+    circuit = Circuit()
+    circuit.failure(0, available=False)
+    assert circuit.state == OPEN
+
+
+def test_half_open_lets_one_call_through_per_cooldown():
+    circuit = Circuit()
+    circuit.trip(0)
+    cooldown = 1e-3*Circuit.COOLDOWN
+    assert not circuit.due(cooldown/2)
+    assert circuit.due(cooldown)
+    circuit.trial()
+    assert circuit.state == HALF_OPEN
+    assert not circuit.due(cooldown)  # The probe is claimed
+
+    # A failed trial opens it again, a passed one closes it
+    circuit.failure(cooldown)
+    assert circuit.state == OPEN and circuit.opened == 2
+    assert circuit.due(2*cooldown)
+    circuit.trial()
+    circuit.success()
+    assert circuit.state == CLOSED and circuit.failures == 0
+
+
+def test_calls_to_a_service_without_workers_fail_fast(endpoint):
+    client = mdclient.MajorDomoClient(endpoint, 'test')
+    client.timeout, client.retries = 100, 1
+    assert client.send(b'nobody', [b'x']) is None
+    assert client.circuits[b'nobody'].state == OPEN
+
+    start = time.time()
+    replies = [client.send(b'nobody', [b'x']) for k in range(100)]
+    assert time.time() - start < 0.1
+    assert replies == [[MDP.R_NOT_FOUND]] * 100
+    assert client.circuits[b'nobody'].rejected == 100
@@ -0,0 +1,62 @@
+import time
+import threading
+
+from rock import msg as codec
+from rock.mdp import MDP, broker as mdbroker, client as mdclient, aclient as maclient
+
+from conftest import free_endpoint, start_worker
+
+
+def test_timeouts_recover_from_latency_step_up(endpoint):
+    delay = [0.001]
+
+    def echo(msg):
+        time.sleep(delay[0])
+        return msg
+
+    start_worker(endpoint, b'echo', echo)
+    client = mdclient.MajorDomoClient(endpoint, 'test')
+    for k in range(30):
+        assert client.send(b'echo', [b'%d' % k]) == [b'%d' % k]
+    timeout, hedge = client.timeouts(b'echo')
+    assert timeout < 0.2  # adapted to the fast replies
+
+    # The service slows down past the adapted timeout, calls widen the
+    # timeout and keep getting through instead of tripping the breaker
+    delay[0] = 0.2
+    replies = [client.send(b'echo', [b'%d' % k]) for k in range(10)]
+    assert replies == [[b'%d' % k] for k in range(10)]
+    assert client.timeouts(b'echo')[0] >= 0.2
+    assert client.circuits[b'echo'].state == 'closed'
+
+
+def test_replayed_request_reaches_client_after_broker_restart(tmp_path):
+    endpoint = free_endpoint()
+    broker = mdbroker.MajorDomoBroker('test', journal=str(tmp_path))
+    broker.bind(endpoint)
+    client = maclient.MajorDomoClient(endpoint, 'test')
+    reply = client.call(b'echo', [b'x'], timeout=5000)
+    assert broker.socket.poll(2000)
+    broker.drain()  # Queued and journaled, no worker for it yet
+    broker.destroy()
+
+    # The client reconnects under the same identity, so the restarted
+    # broker's reply to the replayed request still finds it
+    broker = mdbroker.MajorDomoBroker('test', journal=str(tmp_path))
+    broker.bind(endpoint)
+    threading.Thread(target=broker.mediate, daemon=True).start()
+    assert client.call(b'mmi.service', [b'echo']).result()  # reconnected
+    start_worker(endpoint, b'echo', lambda msg: msg)
+    assert reply.result() == [b'x']
+
+
+def test_broker_restarts_over_journaled_bad_properties(tmp_path):
+    broker = mdbroker.MajorDomoBroker('test', journal=str(tmp_path))
+    for frame in (codec.pack([1, 2]), b'\xc1'):
+        broker.process_client(b'c', [b'echo', frame, b'x'], MDP.C_CLIENT_X)
+    broker.destroy()
+
+    broker = mdbroker.MajorDomoBroker('test', journal=str(tmp_path))
+    requests = list(broker.services[b'echo'].requests)
+    assert [r.properties for r in requests] == [None, None]
+    broker.destroy()
@@ -0,0 +1,122 @@
+import time
+import threading
+import collections
+
+from rock import msg, rpc
+
+from conftest import start_worker
+
+
+def start_service(endpoint, info):
+    """A service whose info replies info, counting calls by method."""
+    calls = collections.Counter()
+
+    def handle(message):
+        method = msg.unpack(message[-1])['method']
+        calls[method] += 1
+        if method == 'info':
+            return [msg.pack(info)]
+        return [msg.pack(dict(ok=True, calls=calls[method]))]
+
+    start_worker(endpoint, b'ttl', handle)
+    return calls
+
+
+def test_failed_info_is_not_asked_on_every_call(endpoint):
+    calls = start_service(endpoint, dict(ok=False, error='Boom'))
+    proxy = rpc.RpcProxy(endpoint, 'ttl', cache=rpc.ReplyCache())
+    assert [proxy.get()['calls'] for k in range(5)] == [1, 2, 3, 4, 5]
+    assert calls['info'] == 1
+
+
+def test_only_blocking_proxies_ask_for_ttls(endpoint):
+    info = dict(rpc=[dict(method='get', args=[], ttl=60)])
+    calls = start_service(endpoint, info)
+    proxy = rpc.AsyncRpcProxy(endpoint, 'ttl', cache=rpc.ReplyCache())
+    assert proxy.get().result()['ok']
+    assert calls['info'] == 0
+
+    proxy = rpc.RpcProxy(endpoint, 'ttl', cache=rpc.ReplyCache())
+    assert [proxy.get()['calls'] for k in range(3)] == [2, 2, 2]
+    assert calls['info'] == 1
+
+
+def test_pipelined_proxies_use_the_calling_threads_socket(endpoint):
+    start_service(endpoint, dict(rpc=[]))
+    proxy = rpc.AsyncRpcProxy(endpoint, 'ttl')
+    other = rpc.AsyncRpcProxy(endpoint, 'ttl')
+    main = proxy.get._client
+    assert other.get._client is main  # Shared within a thread
+    seen = []
+
+    def call():
+        seen.append(proxy.get._client)
+        seen.append(proxy.get().result()['ok'])
+
+    thread = threading.Thread(target=call)
+    thread.start()
+    thread.join()
+    assert seen[0] is not main and seen[0].client is not main.client
+    assert seen[1] is True
+
+
+def test_identical_calls_in_flight_share_one_request(endpoint):
+    calls = collections.Counter()
+
+    def handle(message):
+        calls[msg.unpack(message[-1])['method']] += 1
+        time.sleep(0.3)  # Long enough for every call to join the first
+        return [msg.pack(dict(ok=True))]
+
+    start_worker(endpoint, b'slow', handle)
+    flight = rpc.SingleFlight()
+    proxy = rpc.RpcProxy(endpoint, 'slow', flight=flight)
+    replies = []
+    threads = [
+        threading.Thread(target=lambda: replies.append(proxy.get()))
+        for k in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert replies == [dict(ok=True)] * 8
+    assert calls['get'] == 1 and flight.collapsed == 7
+
+
+class Interrupted(BaseException):
+    pass
+
+
+def test_waiting_calls_are_released_if_the_first_is_interrupted():
+    flight = rpc.SingleFlight()
+    joined = threading.Event()
+    errors = []
+
+    def send():
+        joined.wait(2)
+        raise Interrupted()
+
+    def first():
+        try:
+            flight.run('key', send)
+        except Interrupted as err:
+            errors.append(err)
+
+    def second():
+        while not flight.calls:
+            time.sleep(0.01)
+        threading.Timer(0.1, joined.set).start()
+        try:
+            flight.run('key', lambda: None)
+        except Interrupted as err:
+            errors.append(err)
+
+    threads = [
+        threading.Thread(target=f, daemon=True) for f in (first, second)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    assert len(errors) == 2 and flight.collapsed == 1
@@ -0,0 +1,51 @@
+import threading
+
+from rock import rpc, svc
+
+
+class Calc(svc.BaseService):
+    _name = 'calc'
+    _version = '0.0.1'
+
+    def add(self, a, b):
+        return dict(sum=a + b)
+
+    def fail(self):
+        raise ValueError('bad')
+
+    def _setup_cloud(self, credentials, stage):
+        pass
+
+    def _setup_service(self, bucket):
+        pass
+
+
+def start_calc(endpoint):
+    service = Calc(dict(
+        credentials=None, stage=None, broker=endpoint, verbose=False,
+        bucket=None
+    ))
+    threading.Thread(target=service, daemon=True).start()
+
+
+def check(add, fail, missing):
+    assert add.result() == dict(sum=3, ok=True)
+    assert fail.result()['ok'] is False
+    assert fail.result()['error'] == 'ValueError'
+    assert missing.result()['ok'] is False
+
+
+def test_batch_round_trip(endpoint):
+    start_calc(endpoint)
+    proxy = rpc.RpcProxy(endpoint, 'calc')
+    with proxy.batch() as batch:
+        results = batch.add(a=1, b=2), batch.fail(), batch.missing()
+    check(*results)
+
+
+def test_async_batch_round_trip(endpoint):
+    start_calc(endpoint)
+    proxy = rpc.AsyncRpcProxy(endpoint, 'calc')
+    with proxy.batch() as batch:
+        results = batch.add(a=1, b=2), batch.fail(), batch.missing()
+    check(*results)